@@ -9,7 +9,27 @@ def create_app(*args, **kwargs):
     
     with app.app_context():
         from . import routes
+        from .playlist_cache import playlistCache
+        from .spotify_client import client
+        from . import tracing
+        from . import gpt_integration
+        from .jobs import jobManager
+        from .candidate_pool import candidatePools
+        from .credentials import credentials
+        from .track_metadata import trackMetadata
+        from .playlist_corpus import playlistCorpus
+        from .warmup import startWarmUp
         routes.init_mail(app)
+        client.init_app(app)
+        playlistCache.init_app(app)
+        tracing.init_app(app)
+        gpt_integration.init_app(app)
+        jobManager.init_app(app)
+        candidatePools.init_app(app)
+        credentials.init_app(app)
+        trackMetadata.init_app(app)
+        playlistCorpus.init_app(app)
         app.register_blueprint(routes.bp)
+        startWarmUp(app)
     
     return app
\ No newline at end of file
@@ -0,0 +1,81 @@
+# Author: Adrian Simon
+# Track frequency aggregation used by the streaming playlist pipeline (streaming.py).
+# Playlists can be added in any order (e.g. as their fetches complete), but every track remembers the position at which a
+# sequential run would first have seen it. Ties are broken by that position, so the result does not depend on network timing.
+# Three interchangeable backends exist: the exact dictionary counter below, the NumPy ranking engine in ranking.py (the default),
+# and the bounded-memory Space-Saving counter in heavy_hitters.py for very large candidate pools.
+
+from flask import current_app
+
+from .heavy_hitters import DEFAULT_CAPACITY, SpaceSavingCounter
+from .ranking import RankingEngine, encodeOrder
+from .spotify import topKMostFrequentTracks
+
+# Backend used when RANKING_BACKEND is not set in config.py. "numpy" is the ranking engine, "exact" is TrackCounter and
+# "spacesaving" is SpaceSavingCounter.
+DEFAULT_BACKEND = "numpy"
+
+# Creates the aggregator configured in config.py (RANKING_BACKEND, RANKING_WEIGHTS and SPACE_SAVING_CAPACITY).
+# Must be called with an app context.
+def createAggregator(backend=None, weights=None):
+    if backend is None:
+        backend = current_app.config.get('RANKING_BACKEND', DEFAULT_BACKEND)
+    if weights is None:
+        weights = current_app.config.get('RANKING_WEIGHTS')
+    if backend == "numpy":
+        return RankingEngine(weights)
+    if backend == "exact":
+        return TrackCounter()
+    if backend == "spacesaving":
+        return SpaceSavingCounter(current_app.config.get('SPACE_SAVING_CAPACITY', DEFAULT_CAPACITY))
+    raise ValueError(f"Unknown ranking backend: {backend}")
+
+# Exact counter backed by a dictionary, ranked by topKMostFrequentTracks() in spotify.py.
+class TrackCounter:
+    def __init__(self):
+        self.counts = {}
+        self.firstSeen = {}
+
+    # Counts one occurrence of a track. orderKey is any sortable value giving the track's position in a sequential run.
+    def add(self, trackID, orderKey):
+        count = self.counts.get(trackID)
+        if count is None:
+            self.counts[trackID] = 1
+            self.firstSeen[trackID] = orderKey
+        else:
+            self.counts[trackID] = count + 1
+            if orderKey < self.firstSeen[trackID]:
+                self.firstSeen[trackID] = orderKey
+
+    # Counts every track of a playlist. entries are (trackID, explicit) tuples as returned by fetchPlaylistTracks().
+    # playlistOrder is the playlist's position in a sequential run, e.g. (keyphrase index, search result index).
+    # followers is accepted for compatibility with RankingEngine and ignored, every occurrence counts as 1.
+    # With unique=True a track listed several times in the playlist is only counted once (used by the adaptive fetch mode).
+    def addPlaylist(self, entries, playlistOrder, excludeExplicit, followers=None, unique=False):
+        counted = set() if unique else None
+        for position, (trackID, explicit) in enumerate(entries):
+            if excludeExplicit and explicit:
+                continue
+            if trackID:
+                if counted is not None:
+                    if trackID in counted:
+                        continue
+                    counted.add(trackID)
+                self.add(trackID, (playlistOrder, position))
+
+    # The most a single track's score can grow by when a playlist is added with unique=True.
+    def maxPlaylistWeight(self, playlistOrder, followers=None):
+        return 1
+
+    # Returns every counted track as (trackID, frequency, order) tuples, order packed with encodeOrder(). Used by candidate_pool.py.
+    def export(self):
+        return [(trackID, count, encodeOrder(*self.firstSeen[trackID])) for trackID, count in self.counts.items()]
+
+    # Counts are exact.
+    def errorBound(self):
+        return 0
+
+    # Returns the k most frequent tracks as (trackID, frequency) tuples, highest frequency first.
+    def topK(self, k):
+        ordered = {trackID: self.counts[trackID] for trackID in sorted(self.counts, key=self.firstSeen.__getitem__)}
+        return topKMostFrequentTracks(ordered, k)
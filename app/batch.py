@@ -0,0 +1,222 @@
+# Author: Adrian Simon
+# Bulk playlist generation used by the batch command (batch.py in the repository root).
+# Jobs are read from a JSONL file and run on a thread pool. Every job goes through the same steps as the web app
+# (keyphrases from OpenAI, streamed search + fetch + ranking from streaming.py), but searches and playlist fetches are shared across
+# the whole batch through SharedRequests: a keyphrase that several jobs produce is searched once and a playlist that several jobs
+# find is fetched once, including when the jobs run at the same time.
+# Results are appended to a JSONL file as soon as each job finishes, so an interrupted batch can be resumed: jobs that already
+# have a successful result in the output file are skipped.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .caching import SingleFlight
+from .generation import cleanKeyphrases
+from .gpt_integration import generateKeyphrases, generatePlaylistName
+from .spotify import addTracksToPlaylist, createTempPlaylist, deletePlaylist, getUserID, loadPlaylistTracks, searchKeyphrase, updatePlaylist
+from .streaming import streamPotentialTracks
+from .tracing import outboundRequests
+
+# Playlist size used for jobs that do not set one.
+DEFAULT_SIZE = 30
+
+# Batch-wide memo of keyphrase searches and playlist fetches. Concurrent requests for the same key share one call (SingleFlight)
+# and later ones reuse the stored result. Failed calls are not stored, so another job can try again.
+class SharedRequests:
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+        self.inFlight = SingleFlight()
+        self.calls = {"search": 0, "load": 0}
+        self.reused = {"search": 0, "load": 0}
+
+    # Returns (result, reused). keep decides whether a result is stored for later callers.
+    def memoized(self, kind, key, keep, fn, *args):
+        with self.lock:
+            if key in self.results:
+                self.reused[kind] += 1
+                return self.results[key], True
+        owner = []
+
+        def call():
+            owner.append(True)
+            with self.lock:
+                self.calls[kind] += 1
+            result = fn(*args)
+            if keep(result):
+                with self.lock:
+                    self.results[key] = result
+            return result
+
+        result = self.inFlight.do(key, call)
+        if not owner:
+            with self.lock:
+                self.reused[kind] += 1
+        return result, not owner
+
+    # Same interface as searchKeyphrase() in spotify.py.
+    def search(self, accessToken, keyphrase, limit=5):
+        key = ("search", keyphrase.strip().lower(), limit)
+        results, _ = self.memoized("search", key, lambda results: results is not None, searchKeyphrase, accessToken, keyphrase, limit)
+        return results
+
+    # Same interface as loadPlaylistTracks() in spotify.py. Reused results are reported as cached.
+    def load(self, accessToken, playlistID, snapshotID, maxPages):
+        key = ("load", playlistID, snapshotID, maxPages)
+        result, reused = self.memoized("load", key, lambda result: result[0] is not None, loadPlaylistTracks,
+                                       accessToken, playlistID, snapshotID, maxPages)
+        if reused:
+            entries, statusCode, _, complete, _ = result
+            return entries, statusCode, 0.0, complete, True
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "reused": dict(self.reused)}
+
+# Reads jobs from a JSONL file. Each line needs a description ("description", "prompt" or "title") and may set "id"
+# (or "request_id"), "size" (or "playlistSize") and "excludeExplicit". Lines without an ID are identified by their line number.
+def loadJobs(path, defaultSize=DEFAULT_SIZE, defaultExcludeExplicit=False):
+    jobs = []
+    with open(path) as f:
+        for lineNumber, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            description = record.get("description") or record.get("prompt") or record.get("title")
+            if not description:
+                print(f"Skipping line {lineNumber} of {path}: no description")
+                continue
+            jobs.append({
+                "id": str(record.get("id") or record.get("request_id") or f"line-{lineNumber}"),
+                "description": description,
+                "size": int(record.get("size") or record.get("playlistSize") or defaultSize),
+                "excludeExplicit": bool(record.get("excludeExplicit", defaultExcludeExplicit)),
+            })
+    return jobs
+
+# Returns the IDs of the jobs that already have a successful result in the output file.
+def loadCompleted(path):
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash, the job simply runs again.
+                continue
+            if "error" not in record:
+                completed.add(record.get("id"))
+    return completed
+
+def endsWithNewline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+# Total outbound requests made so far, per service (see tracing.py).
+def outboundTotals():
+    with outboundRequests.lock:
+        values = dict(outboundRequests.values)
+    totals = {}
+    for (service, _, _), count in values.items():
+        totals[service] = totals.get(service, 0) + count
+    return totals
+
+# Deletes the playlist of a job that failed after creating it.
+def deleteFailedPlaylist(userToken, playlistID):
+    print(f"Deleting playlist {playlistID} of a failed job")
+    if not deletePlaylist(userToken, playlistID):
+        print(f"Could not delete playlist {playlistID}, it stays in the user's library")
+
+# Runs one job and returns its result record. accessToken is used for searches and fetches. If userToken is given, the playlist is
+# also created in that user's library under the suggested name.
+def runJob(app, job, accessToken, shared, userToken=None, userID=None):
+    with app.app_context():
+        start = time.perf_counter()
+        record = {"id": job["id"], "description": job["description"]}
+        keyphrases = cleanKeyphrases(generateKeyphrases(job["description"]))
+        if keyphrases is None:
+            record["error"] = "no keyphrases generated"
+            return record
+        tracks = streamPotentialTracks(accessToken, keyphrases, job["size"], job["excludeExplicit"], shared=shared)
+        if tracks is None:
+            record["error"] = "playlist search or fetch failed"
+            return record
+        record["keyphrases"] = keyphrases
+        record["name"] = generatePlaylistName(job["description"])
+        record["tracks"] = [{"id": trackID, "score": score} for trackID, score in tracks]
+        if userToken:
+            if not record["name"]:
+                record["error"] = "no playlist name generated"
+                return record
+            playlistID = createTempPlaylist(userToken, userID)
+            if not playlistID or playlistID == "whitelist needed":
+                record["error"] = "could not create playlist"
+                return record
+            # A failed job is run again on resume, so its playlist is deleted like rollbackTempPlaylist() in generation.py does
+            # instead of being left behind in the user's library.
+            try:
+                if not addTracksToPlaylist(userToken, playlistID, [f"spotify:track:{trackID}" for trackID, _ in tracks]):
+                    record["error"] = "could not add every track to the playlist"
+                elif not updatePlaylist(userToken, playlistID, record["name"], f"{job['description']}. Playlist generated by Jamify."):
+                    record["error"] = "could not name the playlist"
+            except BaseException:
+                deleteFailedPlaylist(userToken, playlistID)
+                raise
+            if "error" in record:
+                deleteFailedPlaylist(userToken, playlistID)
+                return record
+            record["playlistID"] = playlistID
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        return record
+
+# Runs every job that does not have a result in outputPath yet and appends the results to it. Returns a summary dict.
+def runBatch(app, jobs, outputPath, accessToken, workers=4, userToken=None, resume=True):
+    completed = loadCompleted(outputPath) if resume else set()
+    pending = [job for job in jobs if job["id"] not in completed]
+    if len(pending) < len(jobs):
+        print(f"Resuming: {len(jobs) - len(pending)} of {len(jobs)} jobs already done")
+
+    userID = None
+    if userToken:
+        with app.app_context():
+            userID = getUserID(userToken)
+        if not userID:
+            raise RuntimeError("Could not look up the Spotify user for --user-token")
+
+    shared = SharedRequests()
+    statuses = {"ok": 0, "failed": 0}
+    callsBefore = outboundTotals()
+    writeLock = threading.Lock()
+    start = time.perf_counter()
+    with open(outputPath, "a" if resume else "w") as output, ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        if output.tell() and not endsWithNewline(outputPath):
+            # The last line was cut short by a crash, start the next result on its own line.
+            output.write("\n")
+        futures = {executor.submit(runJob, app, job, accessToken, shared, userToken, userID): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                print(f"Job {job['id']} failed: {e}")
+                record = {"id": job["id"], "description": job["description"], "error": str(e)}
+            statuses["failed" if "error" in record else "ok"] += 1
+            with writeLock:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+            done = statuses["ok"] + statuses["failed"]
+            print(f"[{done}/{len(pending)}] {job['id']}: {record.get('error', 'ok')}")
+
+    elapsed = time.perf_counter() - start
+    callsAfter = outboundTotals()
+    calls = {service: callsAfter.get(service, 0) - callsBefore.get(service, 0) for service in callsAfter}
+    return {"jobs": len(pending), "skipped": len(jobs) - len(pending), "statuses": statuses, "seconds": elapsed,
+            "calls": calls, "shared": shared.stats()}
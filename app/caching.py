@@ -0,0 +1,174 @@
+# Author: Adrian Simon
+# Small in-process caching helpers shared by the rest of the app.
+# TTLCache is a thread-safe LRU cache whose entries also expire after a fixed time, with hit/miss counters.
+# SingleFlight makes concurrent callers asking for the same key share one call instead of each making their own.
+# SharedDatabase is the SQLite file behind the stores that every gunicorn worker on a dyno shares (playlist cache, playlist corpus,
+# job store, credential store). Databases that hold tokens are private: only the user running the app may read them.
+
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Marker for a cache miss, so that None can still be stored as a value.
+MISSING = object()
+
+class TTLCache:
+    def __init__(self, maxSize=1024, ttl=3600):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the cached value for key, or default if it is missing or expired.
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    # Stores value under key, evicting the least recently used entry if the cache is full. ttl overrides the default TTL.
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+# Coalesces concurrent calls for the same key. The first caller runs the function, callers that arrive while it is running
+# wait for it and receive the same result (or the same exception). Nothing is remembered after the call finishes.
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+# Opens a connection to a SQLite database in WAL mode, which lets every gunicorn worker read while one of them writes, and runs the
+# schema statements (CREATE ... IF NOT EXISTS) on it. The connection is in autocommit mode, transactions are started explicitly.
+def openSharedDatabase(path, schema):
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            conn.execute(statement)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+# Returns the default path of a private database: a file in a directory of the temp dir that only this user can enter. The temp
+# dir itself is shared with every local user, so the directory is created 0700 and refused if someone else created it first.
+def privateDatabasePath(name):
+    directory = os.path.join(tempfile.gettempdir(), f"jamify-{os.geteuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    checkPrivate(directory)
+    return os.path.join(directory, name)
+
+# Raises PermissionError unless path belongs to this user and is not a symlink, and takes away any access for group and others.
+def checkPrivate(path):
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.geteuid():
+        raise PermissionError(f"Refusing to use {path}: it is a symlink or belongs to another user")
+    if info.st_mode & 0o077:
+        os.chmod(path, stat.S_IMODE(info.st_mode) & 0o700)
+
+# A SQLite database shared between processes through its file. SQLite connections cannot be shared between threads, so each thread
+# opens its own. Connections are opened lazily, which also means each gunicorn worker opens its own after forking. Changing path
+# (e.g. from init_app()) makes every thread reconnect.
+# A private database is created readable and writable by this user only (SQLite gives its -wal and -shm files the same mode), and
+# one that already exists but belongs to another user is refused. With path None it lives in privateDatabasePath(name).
+class SharedDatabase:
+    def __init__(self, path, schema, private=False, name=None):
+        self.path = path
+        self.schema = schema
+        self.private = private
+        self.name = name
+        self.local = threading.local()
+
+    # Creates a private database's file 0600 if it does not exist yet and checks the file and its -wal and -shm files. Raises
+    # PermissionError for files that cannot be trusted. Stores call it from init_app(), so the app refuses to start on them.
+    def secure(self):
+        if not self.private:
+            return
+        if self.path is None:
+            self.path = privateDatabasePath(self.name)
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600))
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.lexists(self.path + suffix):
+                checkPrivate(self.path + suffix)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or getattr(self.local, "path", None) != self.path:
+            self.secure()
+            conn = openSharedDatabase(self.path, self.schema)
+            self.local.conn = conn
+            self.local.path = self.path
+        return conn
@@ -0,0 +1,266 @@
+# Author: Adrian Simon
+# Per-session store of candidate pools, so that regenerating a playlist does not repeat the expensive steps.
+# A candidate pool remembers what a generation found for a description: the keyphrases OpenAI returned, the IDs of the playlists
+# that were counted, and every candidate track's score, first-seen position and explicit flag. With it:
+#   discarding and regenerating with the same description but a different size or explicit setting only reruns the ranking
+#   "more like this" (a refined description) only searches the keyphrases that are new and only fetches playlists not in the pool
+# Scores are summed over playlists, so adding the scores of new playlists to the pool gives the same result as counting everything
+# in one run. Explicit is a property of the track, so excluding explicit tracks is just a filter at ranking time.
+# Pools are stored compactly (17 byte packed track IDs, see playlist_cache.py, plus NumPy arrays) in a SQLite database shared by
+# every gunicorn worker, like the playlist cache, so a regeneration finds the pool whichever worker it lands on. They are kept with
+# an LRU limit and a TTL, and a miss simply means a full generation. The session only holds the pool's ID.
+# A pool needs every playlist counted, which adaptive fetching (ADAPTIVE_FETCH, see streaming.py) skips by design, so a generation
+# can use one or the other. Pools are on by default but off when ADAPTIVE_FETCH is on. Setting CANDIDATE_POOL_ENABLED = True as
+# well keeps the pools, and web generations then fetch every playlist (adaptive fetching still applies to batch generations).
+
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from .caching import SharedDatabase
+from .playlist_cache import TRACK_ID_BYTES, decodeTrackID, encodeTrackID
+
+# Tables of the candidate pool database. scores and orders are the raw bytes of the NumPy arrays, explicit is a bitmap.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS candidate_pools (
+        id TEXT PRIMARY KEY,
+        description TEXT NOT NULL,
+        keyphrases TEXT NOT NULL,
+        playlist_ids TEXT NOT NULL,
+        track_ids BLOB NOT NULL,
+        scores BLOB NOT NULL,
+        orders BLOB NOT NULL,
+        explicit BLOB NOT NULL,
+        integral INTEGER NOT NULL,
+        used_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS candidate_pools_used_at ON candidate_pools (used_at)",
+]
+
+# A pool as read from the pool store. merge() writes it back.
+class CandidatePool:
+    def __init__(self, store, description, poolID=None):
+        self.store = store
+        self.id = poolID or secrets.token_urlsafe(16)
+        self.description = description
+        self.keyphrases = []
+        self.playlistIDs = set()
+        # One row per candidate track.
+        self.trackIDs = b""
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.orders = np.zeros(0, dtype=np.int64)
+        self.explicit = np.zeros(0, dtype=bool)
+        # Scores are reported as integers (plain frequencies) unless a weighted ranking produced them.
+        self.integral = True
+        self.lock = threading.Lock()
+
+    # A pool can be reused once a run has been merged into it.
+    @property
+    def ready(self):
+        return bool(self.keyphrases)
+
+    # Loads the pool's stored columns (a row of candidate_pools without id and used_at).
+    def load(self, row):
+        description, keyphrases, playlistIDs, trackIDs, scores, orders, explicit, integral = row
+        self.description = description
+        self.keyphrases = json.loads(keyphrases)
+        self.playlistIDs = set(json.loads(playlistIDs))
+        self.trackIDs = trackIDs
+        self.scores = np.frombuffer(scores, dtype=np.float64).copy()
+        self.orders = np.frombuffer(orders, dtype=np.int64).copy()
+        self.explicit = np.unpackbits(np.frombuffer(explicit, dtype=np.uint8), count=len(self.scores)).astype(bool)
+        self.integral = bool(integral)
+
+    # Returns the pool's columns in the order load() takes them.
+    def dump(self):
+        return (self.description, json.dumps(self.keyphrases), json.dumps(sorted(self.playlistIDs)), self.trackIDs,
+                self.scores.tobytes(), self.orders.tobytes(), np.packbits(self.explicit).tobytes(), int(self.integral))
+
+    # Merges the results of a successful run into the pool and stores it. scores are (trackID, score, order) tuples from an
+    # aggregator's export(), explicitIDs is the set of explicit tracks among them. Only called once a run has finished, so a failed
+    # run leaves the pool as it was. The pool is reloaded and written back in one transaction, so runs on other workers that
+    # merged into it in the meantime are kept. If the pool cannot be stored, the run's results are only merged into this copy.
+    # A concurrent run (e.g. two refinements of the same pool) may have counted some of the same playlists first. Their scores are
+    # never added twice: recount(skipped) must return the run's scores without the playlists in skipped, and without recount a run
+    # that overlaps the pool is not merged at all.
+    def merge(self, keyphrases, playlistIDs, scores, explicitIDs, recount=None):
+        with self.lock:
+            try:
+                with self.store.transaction() as conn:
+                    row = conn.execute(
+                        "SELECT description, keyphrases, playlist_ids, track_ids, scores, orders, explicit, integral "
+                        "FROM candidate_pools WHERE id = ?", (self.id,)
+                    ).fetchone()
+                    # The run's description (set by generatePreview() for a refinement) replaces the stored one.
+                    description = self.description
+                    if row is not None:
+                        self.load(row)
+                        self.description = description
+                    self.add(keyphrases, playlistIDs, scores, explicitIDs, recount)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO candidate_pools (id, description, keyphrases, playlist_ids, track_ids, scores, orders, "
+                        "explicit, integral, used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.id, *self.dump(), time.time()),
+                    )
+            except sqlite3.Error as e:
+                print(f"Candidate pool store write failed: {e}")
+                self.add(keyphrases, playlistIDs, scores, explicitIDs, recount)
+
+    # Adds a run's results to this copy of the pool, leaving out playlists and keyphrases it already has, see merge().
+    def add(self, keyphrases, playlistIDs, scores, explicitIDs, recount=None):
+        skipped = self.playlistIDs.intersection(playlistIDs)
+        if skipped:
+            print(f"Leaving {len(skipped)} playlists already in the candidate pool out of the merge")
+            if recount is None:
+                return
+            scores = recount(skipped)
+            playlistIDs = [playlistID for playlistID in playlistIDs if playlistID not in skipped]
+        known = {k.lower() for k in self.keyphrases}
+        keyphrases = [k for k in keyphrases if k.lower() not in known]
+        index = {self.trackIDs[i * TRACK_ID_BYTES:(i + 1) * TRACK_ID_BYTES]: i for i in range(len(self.scores))}
+        newIDs = bytearray()
+        newScores = []
+        newOrders = []
+        newExplicit = []
+        scoreArray = self.scores.copy()
+        orderArray = self.orders.copy()
+        for trackID, score, order in scores:
+            key = decodeTrackID(trackID)
+            if key is None:
+                print(f"Leaving track {trackID} out of the candidate pool, its ID cannot be packed")
+                continue
+            if not isinstance(score, int):
+                self.integral = False
+            i = index.get(key)
+            if i is None:
+                newIDs += key
+                newScores.append(score)
+                newOrders.append(order)
+                newExplicit.append(trackID in explicitIDs)
+            else:
+                scoreArray[i] += score
+                orderArray[i] = min(orderArray[i], order)
+        self.trackIDs += bytes(newIDs)
+        self.scores = np.concatenate([scoreArray, np.array(newScores, dtype=np.float64)])
+        self.orders = np.concatenate([orderArray, np.array(newOrders, dtype=np.int64)])
+        self.explicit = np.concatenate([self.explicit, np.array(newExplicit, dtype=bool)])
+        self.keyphrases.extend(keyphrases)
+        self.playlistIDs.update(playlistIDs)
+
+    # Returns the numSongs best tracks as (trackID, score) tuples, highest score first, ties broken by first-seen position
+    # like the aggregators do.
+    def rank(self, numSongs, excludeExplicit):
+        with self.lock:
+            scores = self.scores
+            orders = self.orders
+            candidates = np.flatnonzero(~self.explicit) if excludeExplicit else np.arange(len(scores))
+            trackIDs = self.trackIDs
+        if numSongs <= 0 or len(candidates) == 0:
+            return []
+        if numSongs < len(candidates):
+            # Everything tied with the k-th best score stays a candidate so the tie-break decides who makes the cut.
+            threshold = scores[candidates[np.argpartition(-scores[candidates], numSongs - 1)[numSongs - 1]]]
+            candidates = candidates[scores[candidates] >= threshold]
+        ranked = candidates[np.lexsort((orders[candidates], -scores[candidates]))][:numSongs]
+        convert = int if self.integral else float
+        return [(encodeTrackID(trackIDs[i * TRACK_ID_BYTES:(i + 1) * TRACK_ID_BYTES]), convert(scores[i])) for i in ranked]
+
+class CandidatePoolStore:
+    def __init__(self, maxSize=1024, ttl=1800, enabled=True, path=None):
+        self.enabled = enabled
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.db = SharedDatabase(path, SCHEMA, private=True, name="jamify_candidate_pools.sqlite3")
+
+    # Reads optional overrides from config.py (CANDIDATE_POOL_SIZE, CANDIDATE_POOL_TTL, CANDIDATE_POOL_ENABLED, CANDIDATE_POOL_PATH).
+    # Called once from create_app(). Without CANDIDATE_POOL_ENABLED, pools follow ADAPTIVE_FETCH, see the top of this file.
+    # The store holds users' descriptions, so it is private like the job store, see SharedDatabase in caching.py.
+    def init_app(self, app):
+        adaptive = app.config.get('ADAPTIVE_FETCH', False)
+        self.enabled = app.config.get('CANDIDATE_POOL_ENABLED', self.enabled and not adaptive)
+        if adaptive and self.enabled:
+            print("CANDIDATE_POOL_ENABLED overrides ADAPTIVE_FETCH: generations with a candidate pool fetch every playlist")
+        elif adaptive:
+            print("Candidate pools are off because ADAPTIVE_FETCH is on, set CANDIDATE_POOL_ENABLED = True to prefer them")
+        self.maxSize = app.config.get('CANDIDATE_POOL_SIZE', self.maxSize)
+        self.ttl = app.config.get('CANDIDATE_POOL_TTL', self.ttl)
+        self.db.path = app.config.get('CANDIDATE_POOL_PATH', self.db.path)
+        if self.enabled:
+            self.db.secure()
+
+    # Returns this thread's connection to the pool store, see SharedDatabase in caching.py.
+    def connection(self):
+        return self.db.connection()
+
+    # Context manager for a write transaction on this thread's connection, rolled back if the block raises.
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    # Returns the pool with the given ID, or None if it does not exist, has expired or cannot be read.
+    def get(self, poolID):
+        if not self.enabled or poolID is None:
+            return None
+        now = time.time()
+        try:
+            conn = self.connection()
+            row = conn.execute(
+                "SELECT description, keyphrases, playlist_ids, track_ids, scores, orders, explicit, integral "
+                "FROM candidate_pools WHERE id = ? AND used_at > ?", (poolID, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE candidate_pools SET used_at = ? WHERE id = ?", (now, poolID))
+        except sqlite3.Error as e:
+            print(f"Candidate pool store read failed: {e}")
+            return None
+        pool = CandidatePool(self, row[0], poolID)
+        pool.load(row)
+        return pool
+
+    # Creates and stores an empty pool for a description. Returns None if pools are disabled or the pool cannot be stored.
+    def create(self, description):
+        if not self.enabled:
+            return None
+        pool = CandidatePool(self, description)
+        now = time.time()
+        try:
+            with self.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO candidate_pools (id, description, keyphrases, playlist_ids, track_ids, scores, orders, explicit, "
+                    "integral, used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (pool.id, *pool.dump(), now),
+                )
+                self.evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"Candidate pool store write failed: {e}")
+            return None
+        return pool
+
+    # Drops expired pools, then the least recently used ones until the store is back under maxSize.
+    def evict(self, conn, now):
+        conn.execute("DELETE FROM candidate_pools WHERE used_at < ?", (now - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM candidate_pools").fetchone()[0]
+        if count > self.maxSize:
+            conn.execute(
+                "DELETE FROM candidate_pools WHERE id IN (SELECT id FROM candidate_pools ORDER BY used_at LIMIT ?)",
+                (count - self.maxSize,),
+            )
+
+# Single pool store for this process. Other processes share the pools through the SQLite file.
+candidatePools = CandidatePoolStore()
@@ -0,0 +1,185 @@
+# Author: Adrian Simon
+# Per-session Spotify credentials and identity.
+# At login the session keeps the access token, when it expires and the user's Spotify ID, so generations do not need a /v1/me round
+# trip and an expired access token does not send the user back through /login. currentAccessToken() refreshes the access token a
+# few minutes before it expires.
+# The refresh token never goes into the session cookie (Flask's session is a signed but readable cookie, and a refresh token does not
+# expire). It is kept server side in a SQLite database shared by every gunicorn worker, under a random handle that is all the cookie
+# holds. Logging out deletes it. The database is private to the user running the app (mode 0600, by default in a 0700 directory of
+# the temp dir), and the app refuses to start if CREDENTIAL_STORE_PATH points at a file that belongs to another user.
+# A browser often has several requests in flight with the same session cookie (e.g. the preview page and job polling), so refreshes
+# are single-flight per handle, and the refreshed access token is stored with the refresh token: a request that still carries the
+# old cookie, in any worker, picks the new token up from the store instead of refreshing again (Spotify may rotate the refresh
+# token, making the old one invalid).
+# Sessions from before this change only hold access_token, and keep working until that token expires. Sessions that still carry a
+# refresh token in the cookie have it moved into the store on their next refresh.
+
+import secrets
+import sqlite3
+import time
+
+import requests
+from flask import session
+
+from .caching import SharedDatabase, SingleFlight
+from .spotify import getUserID, refreshAccessToken
+
+# Tables of the credential store database.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS credentials (
+        id TEXT PRIMARY KEY,
+        refresh_token TEXT NOT NULL,
+        access_token TEXT,
+        expires_at REAL,
+        used_at REAL NOT NULL
+    )
+    """,
+]
+
+class CredentialStore:
+    def __init__(self, path=None, refreshMargin=300, ttl=60 * 24 * 3600):
+        self.db = SharedDatabase(path, SCHEMA, private=True, name="jamify_credentials.sqlite3")
+        # Seconds before expiry at which the access token is refreshed, so a generation never starts with a token about to expire.
+        self.refreshMargin = refreshMargin
+        # Stored refresh tokens not used for this many seconds are deleted at the next login.
+        self.ttl = ttl
+        self.inFlight = SingleFlight()
+
+    # Reads optional overrides from config.py (TOKEN_REFRESH_MARGIN, CREDENTIAL_STORE_PATH, CREDENTIAL_TTL). Called once from create_app().
+    # Raises PermissionError if the store's file belongs to another user, see SharedDatabase in caching.py.
+    def init_app(self, app):
+        self.refreshMargin = app.config.get('TOKEN_REFRESH_MARGIN', self.refreshMargin)
+        self.db.path = app.config.get('CREDENTIAL_STORE_PATH', self.db.path)
+        self.ttl = app.config.get('CREDENTIAL_TTL', self.ttl)
+        self.db.secure()
+
+    # Returns this thread's connection to the credential store, see SharedDatabase in caching.py.
+    def connection(self):
+        return self.db.connection()
+
+    # Saves an access token and its expiry in the session.
+    def save(self, tokenData):
+        session['access_token'] = tokenData.get('access_token')
+        session['token_expires_at'] = tokenData.get('expires_at') or time.time() + tokenData.get('expires_in', 3600)
+
+    # Stores a refresh token under a new handle and puts the handle in the session. Returns the handle, or None if it could not be stored.
+    def store(self, refreshToken, accessToken=None, expiresAt=None):
+        handle = secrets.token_urlsafe(32)
+        try:
+            self.connection().execute(
+                "INSERT INTO credentials (id, refresh_token, access_token, expires_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                (handle, refreshToken, accessToken, expiresAt, time.time()),
+            )
+        except sqlite3.Error as e:
+            print(f"Credential store write failed: {e}")
+            return None
+        session['credential_id'] = handle
+        return handle
+
+    # Stores the credentials of a new login and looks up the user's Spotify ID once for the whole session.
+    def login(self, tokenData):
+        self.forget()
+        session.pop('user_id', None)
+        self.save(tokenData)
+        if tokenData.get('refresh_token'):
+            self.store(tokenData['refresh_token'], session['access_token'], session['token_expires_at'])
+            self.evict()
+        # Without a user ID the first generation looks it up itself, so an unreachable API must not fail the login.
+        try:
+            userID = getUserID(tokenData.get('access_token'))
+        except requests.RequestException as e:
+            print(f"Error fetching user ID: {e}")
+            userID = None
+        if userID:
+            session['user_id'] = userID
+
+    # Deletes the session's stored refresh token, called on logout and before a new login.
+    def forget(self):
+        handle = session.pop('credential_id', None)
+        session.pop('refresh_token', None)
+        if handle is None:
+            return
+        try:
+            self.connection().execute("DELETE FROM credentials WHERE id = ?", (handle,))
+        except sqlite3.Error as e:
+            print(f"Credential store write failed: {e}")
+
+    # Deletes refresh tokens that have not been used within the TTL.
+    def evict(self):
+        try:
+            self.connection().execute("DELETE FROM credentials WHERE used_at < ?", (time.time() - self.ttl,))
+        except sqlite3.Error as e:
+            print(f"Credential store write failed: {e}")
+
+    # Returns a valid access token for the session, refreshing it if it expires within refreshMargin seconds.
+    # Returns None if the session has no token or it could not be refreshed, in which case the user has to log in again.
+    def currentAccessToken(self):
+        accessToken = session.get('access_token')
+        if accessToken is None:
+            return None
+        expiresAt = session.get('token_expires_at')
+        if expiresAt is None or expiresAt - self.refreshMargin > time.time():
+            return accessToken
+        handle = session.get('credential_id')
+        if handle is None and session.get('refresh_token'):
+            # Session from before refresh tokens were kept server side.
+            handle = self.store(session.pop('refresh_token'), accessToken, expiresAt)
+        if handle is None:
+            return accessToken if expiresAt > time.time() else None
+        tokenData = self.inFlight.do(handle, self.refresh, handle)
+        if tokenData is None:
+            # Refresh failed. The current token is still usable until it actually expires.
+            return accessToken if expiresAt > time.time() else None
+        self.save(tokenData)
+        return session['access_token']
+
+    # Returns a fresh token response for a handle as {"access_token", "expires_at"}, or None if it could not be refreshed. A token
+    # another request (or worker) already refreshed is taken from the store.
+    def refresh(self, handle):
+        try:
+            row = self.storedToken(handle)
+            if row is None:
+                return None
+            refreshToken, tokenData = row
+            if tokenData is not None:
+                return tokenData
+            response = refreshAccessToken(refreshToken)
+            if response is None:
+                # Another worker may have refreshed (and rotated) the token in the meantime.
+                row = self.storedToken(handle)
+                return row[1] if row is not None else None
+        except sqlite3.Error as e:
+            print(f"Credential store read failed: {e}")
+            return None
+        print("Refreshed Spotify access token")
+        now = time.time()
+        tokenData = {"access_token": response.get('access_token'), "expires_at": now + response.get('expires_in', 3600)}
+        try:
+            self.connection().execute(
+                "UPDATE credentials SET refresh_token = ?, access_token = ?, expires_at = ?, used_at = ? WHERE id = ?",
+                (response.get('refresh_token') or refreshToken, tokenData["access_token"], tokenData["expires_at"], now, handle),
+            )
+        except sqlite3.Error as e:
+            print(f"Credential store write failed: {e}")
+        return tokenData
+
+    # Returns (refresh token, token response) for a handle, where the token response is None unless the stored access token is
+    # still good for more than refreshMargin seconds. Returns None for an unknown handle.
+    def storedToken(self, handle):
+        row = self.connection().execute(
+            "SELECT refresh_token, access_token, expires_at FROM credentials WHERE id = ?", (handle,)
+        ).fetchone()
+        if row is None:
+            return None
+        refreshToken, accessToken, expiresAt = row
+        if accessToken and expiresAt and expiresAt - self.refreshMargin > time.time():
+            return refreshToken, {"access_token": accessToken, "expires_at": expiresAt}
+        return refreshToken, None
+
+    # Returns the session's Spotify user ID, or None if it is not known (the generation then looks it up itself).
+    def userID(self):
+        return session.get('user_id')
+
+# Single credential store for this process. Other processes share the refresh tokens through the SQLite file.
+credentials = CredentialStore()
@@ -0,0 +1,89 @@
+# Author: Adrian Simon
+# Small dependency-graph executor used to run the steps of playlist generation concurrently.
+# Each stage is a function that receives the results of the stages it depends on as keyword arguments.
+# A stage starts as soon as all of its dependencies have finished, so independent stages (e.g. the OpenAI call and the
+# Spotify user lookup) overlap instead of running one after another.
+# If any stage fails, no new stages are started, running stages are allowed to finish, and the rollback function of every
+# stage that completed is called (in reverse order) so nothing is left behind, e.g. the temporary playlist.
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .tracing import submitWithContext
+
+# Raised by a stage to stop the pipeline. template is the error page that should be shown to the user.
+class StageFailed(Exception):
+    def __init__(self, template, message=None):
+        super().__init__(message or template)
+        self.template = template
+
+# Raised by StageGraph.run() when the run was cancelled. Completed stages have been rolled back.
+class PipelineCancelled(Exception):
+    pass
+
+# How often a running graph checks its cancellation event, in seconds.
+CANCEL_POLL_INTERVAL = 0.25
+
+class StageGraph:
+    def __init__(self):
+        self.stages = {}
+
+    # Adds a stage. deps are the names of stages whose results are passed to fn as keyword arguments.
+    # rollback, if given, is called with the stage's result when a later stage fails.
+    def add(self, name, fn, deps=(), rollback=None):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = {"fn": fn, "deps": tuple(deps), "rollback": rollback}
+
+    # Runs every stage and returns a dict of stage name to result.
+    # When stages fail, the failure of the earliest added stage is raised, which matches the error a sequential run would have hit first.
+    # Each stage runs in a copy of the caller's context, so Flask's application context (current_app) and the request's trace
+    # (tracing.py) are available inside stages.
+    # progress, if given, is called with the name of every stage that completes. cancelled is an optional threading.Event; once it is
+    # set no new stages are started, and when the running ones finish everything is rolled back and PipelineCancelled is raised.
+    def run(self, progress=None, cancelled=None):
+        results = {}
+        failures = {}
+        futures = {}
+        order = list(self.stages)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(order))) as executor:
+            while True:
+                stopping = failures or (cancelled is not None and cancelled.is_set())
+                if not stopping:
+                    for name in order:
+                        stage = self.stages[name]
+                        if name in futures or not all(dep in results for dep in stage["deps"]):
+                            continue
+                        kwargs = {dep: results[dep] for dep in stage["deps"]}
+                        futures[name] = submitWithContext(executor, stage["fn"], **kwargs)
+
+                pending = [future for name, future in futures.items() if name not in results and name not in failures]
+                if not pending:
+                    break
+                done, _ = wait(pending, timeout=CANCEL_POLL_INTERVAL if cancelled is not None else None, return_when=FIRST_COMPLETED)
+                for name, future in futures.items():
+                    if future in done:
+                        try:
+                            results[name] = future.result()
+                        except Exception as e:
+                            failures[name] = e
+                            continue
+                        if progress:
+                            progress(name)
+
+        # A stage that fails once the run is cancelled usually failed because of it (e.g. streamPotentialTracks() returns None).
+        if cancelled is not None and cancelled.is_set():
+            failures[None] = PipelineCancelled()
+        if failures:
+            for name in reversed(order):
+                rollback = self.stages[name]["rollback"]
+                if rollback and name in results:
+                    try:
+                        rollback(results[name])
+                    except Exception as e:
+                        print(f"Rollback of stage {name} failed: {e}")
+            if None in failures:
+                raise failures[None]
+            raise failures[next(name for name in order if name in failures)]
+        return results
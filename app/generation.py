@@ -0,0 +1,160 @@
+# Author: Adrian Simon
+# Playlist generation pipeline used by the preview_playlist route.
+# The steps are laid out as a dependency graph (executor.py) instead of running strictly in sequence:
+#   keyphrases (OpenAI) -> tracks (streamed search + fetch + count, see streaming.py) --\
+#   userID (Spotify) -> tempPlaylist ------------------------------------------------------> add tracks
+# so the Spotify user lookup and temporary playlist creation happen while OpenAI is still generating keyphrases.
+# The suggested playlist name is also generated speculatively in the background, so the save page finds it in the name cache.
+# With LLM_STREAMING = True in config.py, keyphrases and the playlist name come from one streamed OpenAI completion instead: the
+# keyphrases stage disappears and the tracks stage starts each keyphrase's search as soon as it has been streamed, and the name is
+# cached for the save page from the same response.
+# With a candidate pool (candidate_pool.py) from an earlier generation, regenerating the same description skips OpenAI and the
+# playlist search and fetch entirely, and a refined description only searches its new keyphrases.
+# Regenerating into the temporary playlist that is already being previewed replaces its tracks in place instead of deleting it and
+# creating a new one, so the userID and tempPlaylist stages disappear. The userID stage is also skipped when the session already
+# knows the user's Spotify ID (see credentials.py).
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .executor import StageFailed, StageGraph
+from . import gpt_integration
+from .gpt_integration import generateKeyphrases, generatePlaylistName, streamKeyphrasesAndName
+from .spotify import getUserID, createTempPlaylist, addTracksToPlaylist, deletePlaylist, replacePlaylistTracks
+from .streaming import streamPotentialTracks
+from .tracing import stage
+from .track_metadata import trackMetadata
+
+# Background work that nobody waits for (speculative name generation).
+backgroundExecutor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="jamify-background")
+
+# Starts generating the suggested playlist name without waiting for it. The result lands in the name cache in gpt_integration.py,
+# and if the user reaches the save page before it finishes, generatePlaylistName() joins the in-flight call instead of making a new one.
+def prefetchPlaylistName(description):
+    backgroundExecutor.submit(generatePlaylistName, description)
+
+# Cleans up the raw keyphrase list returned by OpenAI. Returns None if no usable keyphrases were generated.
+def cleanKeyphrases(keyphrases):
+    if keyphrases is None:
+        return None
+    keyphrases = [k.strip() for k in keyphrases if k.strip()]
+    if not keyphrases or [k.lower() for k in keyphrases] == ["none"]:
+        return None
+    return keyphrases
+
+# Generates a playlist for the description and adds it to a temporary playlist in the user's library.
+# Returns the temporary playlist's ID. Raises StageFailed with the error page to show if any step fails (including writing the
+# tracks), in which case the temporary playlist (if it was already created) has been deleted.
+# progress and cancelled are passed to StageGraph.run(). A cancelled run raises PipelineCancelled after deleting the temporary playlist.
+# pool is an optional CandidatePool. If it already holds this description's candidates, only the ranking is rerun. If it holds the
+# candidates of another description (a "more like this" refinement), only the keyphrases it does not have yet are searched.
+# playlistID is an optional existing temporary playlist to regenerate into. Its tracks are replaced and it is returned. It is never
+# deleted, not even when the generation fails or is cancelled.
+# userID is the user's Spotify ID if it is already known, otherwise it is looked up.
+def generatePreview(accessToken, description, numSongs, excludeExplicit, progress=None, cancelled=None, pool=None, playlistID=None,
+                    userID=None):
+    reuse = pool is not None and pool.ready and pool.description == description
+    streamLLM = gpt_integration.streamingEnabled and not reuse
+    if not streamLLM:
+        prefetchPlaylistName(description)
+
+    def keyphrasesStage():
+        with stage("llm"):
+            keyphrases = cleanKeyphrases(generateKeyphrases(description))
+        if keyphrases is None:
+            print("No keyphrases generated.")
+            raise StageFailed('error_processing.html')
+        if pool is not None and pool.ready:
+            known = {k.lower() for k in pool.keyphrases}
+            keyphrases = [k for k in keyphrases if k.lower() not in known]
+            print(f"Refining candidate pool with new keyphrases: {keyphrases}")
+        return keyphrases
+
+    def userIDStage():
+        with stage("user"):
+            userID = getUserID(accessToken)
+        if not userID:
+            raise StageFailed('error_spotify_create.html')
+        return userID
+
+    def tempPlaylistStage(userID):
+        with stage("create"):
+            playlistID = createTempPlaylist(accessToken, userID)
+        if playlistID == "whitelist needed":
+            raise StageFailed('whitelist_form.html')
+        if not playlistID:
+            raise StageFailed('error_spotify_create.html')
+        return playlistID
+
+    def tracksStage(keyphrases):
+        if pool is not None:
+            # Stored with the run's results when they are merged into the pool.
+            pool.description = description
+        tracks = streamPotentialTracks(accessToken, keyphrases, numSongs, excludeExplicit, cancelled=cancelled, pool=pool)
+        if tracks is None:
+            raise StageFailed('error_spotify_fetch.html')
+        print("Tracks generated:", tracks)
+        return tracks
+
+    # Keyphrases from the streamed completion, minus the ones the candidate pool already has. found collects every keyphrase.
+    def keyphraseStream(found):
+        known = {k.lower() for k in pool.keyphrases} if pool is not None and pool.ready else set()
+        for keyphrase in streamKeyphrasesAndName(description):
+            found.append(keyphrase)
+            if keyphrase.lower() not in known:
+                yield keyphrase
+
+    def streamedTracksStage():
+        found = []
+        if pool is not None:
+            pool.description = description
+        tracks = streamPotentialTracks(accessToken, keyphraseStream(found), numSongs, excludeExplicit, cancelled=cancelled, pool=pool)
+        if tracks is not None and not found:
+            print("No keyphrases generated.")
+            raise StageFailed('error_processing.html')
+        if tracks is None:
+            raise StageFailed('error_spotify_fetch.html')
+        print("Tracks generated:", tracks)
+        return tracks
+
+    def rankPoolStage():
+        with stage("rank"):
+            tracks = trackMetadata.rank(accessToken, lambda k: pool.rank(k, excludeExplicit), numSongs)
+        print(f"Tracks ranked from candidate pool of {len(pool.playlistIDs)} playlists:", tracks)
+        return tracks
+
+    def addStage(tracks, tempPlaylist):
+        # streamPotentialTracks returns (trackID, frequency) tuples.
+        trackURIs = [f"spotify:track:{trackID}" for trackID, _ in tracks]
+        with stage("add"):
+            if playlistID:
+                written = replacePlaylistTracks(accessToken, tempPlaylist, trackURIs)
+            else:
+                written = addTracksToPlaylist(accessToken, tempPlaylist, trackURIs)
+        if not written:
+            print(f"Could not write every track to playlist {tempPlaylist}")
+            raise StageFailed('error_spotify_create.html')
+
+    def rollbackTempPlaylist(playlistID):
+        print(f"Deleting temporary playlist {playlistID} after a failed generation")
+        deletePlaylist(accessToken, playlistID)
+
+    graph = StageGraph()
+    if not reuse and not streamLLM:
+        graph.add("keyphrases", keyphrasesStage)
+    if playlistID:
+        # The playlist being previewed is kept even if regenerating it fails.
+        graph.add("tempPlaylist", lambda: playlistID)
+    elif userID:
+        graph.add("tempPlaylist", lambda: tempPlaylistStage(userID), rollback=rollbackTempPlaylist)
+    else:
+        graph.add("userID", userIDStage)
+        graph.add("tempPlaylist", tempPlaylistStage, deps=("userID",), rollback=rollbackTempPlaylist)
+    if reuse:
+        graph.add("tracks", rankPoolStage)
+    elif streamLLM:
+        graph.add("tracks", streamedTracksStage)
+    else:
+        graph.add("tracks", tracksStage, deps=("keyphrases",))
+    graph.add("add", addStage, deps=("tracks", "tempPlaylist"))
+    results = graph.run(progress=progress, cancelled=cancelled)
+    return results["tempPlaylist"]
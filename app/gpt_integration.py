@@ -2,15 +2,88 @@
 # This file contains functions that integrate OpenAI API's natural language processing abilities.
 # Two functions are created here, one being used to extract keyphrases from the user-inputted description,
 # the other being used to generate a suggested name for the playlist.
+# Both results are cached by normalized description, and concurrent calls for the same description share one OpenAI request.
+# streamKeyphrasesAndName() is a third way in (used when LLM_STREAMING = True in config.py): a single streamed completion that
+# produces the keyphrases followed by the playlist name, yielding each keyphrase as soon as it is complete. Concurrent streams for
+# the same description share one completion as well.
+
+import contextvars
+import re
+import threading
+import time
 
 import openai
 from config import OPENAI_API_KEY
 
+from .caching import SingleFlight, TTLCache
+from .tracing import recordOutbound
+
 openai.api_key = OPENAI_API_KEY
 
+# Cached keyphrases and names expire after LLM_CACHE_TTL seconds, at most LLM_CACHE_SIZE descriptions are kept per cache.
+keyphraseCache = TTLCache(maxSize=2048, ttl=24 * 3600)
+nameCache = TTLCache(maxSize=2048, ttl=24 * 3600)
+inFlight = SingleFlight()
+
+# Streamed completions in progress, by normalized description, and how many streams joined one instead of starting their own.
+activeStreams = {}
+activeStreamsLock = threading.Lock()
+streamsCoalesced = 0
+
+# Whether generation.py uses streamKeyphrasesAndName() instead of generateKeyphrases() + a separate name request.
+streamingEnabled = False
+
+# Reads optional overrides from config.py (LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_STREAMING). Called once from create_app().
+def init_app(app):
+    global keyphraseCache, nameCache, streamingEnabled
+    size = app.config.get('LLM_CACHE_SIZE', keyphraseCache.maxSize)
+    ttl = app.config.get('LLM_CACHE_TTL', keyphraseCache.ttl)
+    keyphraseCache = TTLCache(maxSize=size, ttl=ttl)
+    nameCache = TTLCache(maxSize=size, ttl=ttl)
+    streamingEnabled = app.config.get('LLM_STREAMING', streamingEnabled)
+
+# Marks the start of the playlist name in a combined keyphrase + name completion.
+NAME_MARKER = "Name:"
+
+# Normalizes a description for use as a cache key, so that case, whitespace and trailing punctuation variants
+# ("Gym", "  gym ", "gym!") share one entry.
+def normalizeDescription(desc):
+    return re.sub(r"\s+", " ", (desc or "").lower()).strip().rstrip(".!?,;: ")
+
+# Returns hit/miss counters for both caches and the number of calls that were coalesced into an in-flight request.
+def cacheStats():
+    return {
+        "keyphrases": keyphraseCache.stats(),
+        "names": nameCache.stats(),
+        "coalesced": inFlight.coalesced + streamsCoalesced,
+    }
+
 # Generates keyphrases from user-inputted description, takes a description string and returns a list of keyphrases.
 # If description cannot be deciphered or is nonsense, None is returned.
+# Results are served from the keyphrase cache when possible. Failed calls (None) are not cached.
 def generateKeyphrases(desc):
+    key = normalizeDescription(desc)
+    keyphrases = keyphraseCache.get(key)
+    if keyphrases is None:
+        keyphrases = inFlight.do(("keyphrases", key), fetchKeyphrases, desc)
+        if keyphrases is not None:
+            keyphraseCache.set(key, keyphrases)
+    return list(keyphrases) if keyphrases is not None else None
+
+# Generates a suggested playlist name from user-inputted description, returns suggested name.
+# If no name can be generated, None is returned.
+# Results are served from the name cache when possible. Failed calls (None) are not cached.
+def generatePlaylistName(desc):
+    key = normalizeDescription(desc)
+    name = nameCache.get(key)
+    if name is None:
+        name = inFlight.do(("name", key), fetchPlaylistName, desc)
+        if name is not None:
+            nameCache.set(key, name)
+    return name
+
+# Requests keyphrases for a description from OpenAI, uncached. Called by generateKeyphrases().
+def fetchKeyphrases(desc):
     messages = [
         {"role": "system", "content": "You are an assistant that extracts keyphrases from descriptions."},
         {"role": "user", "content": f"""
@@ -26,6 +99,7 @@ def generateKeyphrases(desc):
         """}
     ]
 
+    start = time.perf_counter()
     try:
         # GPT-4o generates the best keyphrases and is cost efficient.
         rawResponse = openai.ChatCompletion.create(
@@ -35,6 +109,7 @@ def generateKeyphrases(desc):
             temperature=0.5,
         )
         response = rawResponse["choices"][0]["message"]["content"]
+        recordOutbound("openai", "POST /v1/chat/completions", 200, len(response.encode()), time.perf_counter() - start)
         print("GPT Response: ", response)
 
         keyphrases = response.split(",")
@@ -42,12 +117,12 @@ def generateKeyphrases(desc):
         return keyphrases
 
     except Exception as e:
+        recordOutbound("openai", "POST /v1/chat/completions", "error", 0, time.perf_counter() - start)
         print(f"An error occurred: {e}")
         return None
 
-# Generates a suggested playlist name from user-inputted description, returns suggested name.
-# If no name can be generated, None is returned.  
-def generatePlaylistName(desc):
+# Requests a suggested playlist name for a description from OpenAI, uncached. Called by generatePlaylistName().
+def fetchPlaylistName(desc):
     messages = [
         {"role": "system", "content": "You are an assistant that generates playlist names from playlist descriptions."},
         {"role": "user", "content": f"""
@@ -60,6 +135,7 @@ def generatePlaylistName(desc):
         """}
     ]
 
+    start = time.perf_counter()
     try:
         rawResponse = openai.ChatCompletion.create(
             model="gpt-4o", 
@@ -68,9 +144,155 @@ def generatePlaylistName(desc):
             temperature=0.5,
         )
         response = rawResponse["choices"][0]["message"]["content"]
+        recordOutbound("openai", "POST /v1/chat/completions", 200, len(response.encode()), time.perf_counter() - start)
         print("GPT Generated Name: ", response)
         return response
 
     except Exception as e:
+        recordOutbound("openai", "POST /v1/chat/completions", "error", 0, time.perf_counter() - start)
+        print(f"An error occurred: {e}")
+        return None
+
+# The keyphrases of one streamed completion, replayed to every caller that shares it.
+class KeyphraseStream:
+    def __init__(self):
+        self.keyphrases = []
+        self.done = False
+        self.changed = threading.Condition()
+
+    def append(self, keyphrase):
+        with self.changed:
+            self.keyphrases.append(keyphrase)
+            self.changed.notify_all()
+
+    def finish(self):
+        with self.changed:
+            self.done = True
+            self.changed.notify_all()
+
+    # Yields every keyphrase from the first one, waiting for new ones until the completion has ended.
+    def __iter__(self):
+        seen = 0
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: len(self.keyphrases) > seen or self.done)
+                keyphrases = self.keyphrases[seen:]
+                done = self.done
+            yield from keyphrases
+            seen += len(keyphrases)
+            if done and not keyphrases:
+                return
+
+# Generates keyphrases and a suggested playlist name for a description with one streamed OpenAI request.
+# Yields each keyphrase as soon as the comma (or line break) after it arrives, so Spotify searches can start while the rest of the
+# completion is still being generated. Once the stream ends, the keyphrases and the name are stored in the caches, so the save page
+# gets the name from generatePlaylistName() without another request.
+# Yields nothing if the description is nonsense or the request failed before any keyphrase arrived. Cached keyphrases are yielded
+# right away without a request. Like generateKeyphrases(), concurrent calls for the same description share one request: the
+# completion runs on its own thread and every caller gets all of its keyphrases, including the ones streamed before it joined.
+# A caller that stops iterating early does not stop the completion, so the others (and the caches) still get all of it.
+def streamKeyphrasesAndName(desc):
+    global streamsCoalesced
+    key = normalizeDescription(desc)
+    cached = keyphraseCache.get(key)
+    if cached is not None:
+        yield from cached
+        return
+
+    with activeStreamsLock:
+        shared = activeStreams.get(key)
+        leader = shared is None
+        if leader:
+            shared = KeyphraseStream()
+            activeStreams[key] = shared
+        else:
+            streamsCoalesced += 1
+    if leader:
+        # Runs in a copy of the caller's context so the request is recorded in the caller's trace.
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(completeKeyphraseStream, desc, key, shared), name="jamify-llm-stream",
+                         daemon=True).start()
+    yield from shared
+
+# Runs the streamed completion for streamKeyphrasesAndName(), appending each keyphrase to shared as soon as it is complete.
+def completeKeyphraseStream(desc, key, shared):
+    try:
+        streamCompletion(desc, key, shared)
+    finally:
+        # Removed only after the caches are filled, so a caller arriving now either joins this stream or hits the cache.
+        with activeStreamsLock:
+            del activeStreams[key]
+        shared.finish()
+
+# Requests the combined keyphrase + name completion from OpenAI and parses it as it streams in, then fills both caches.
+def streamCompletion(desc, key, shared):
+    messages = [
+        {"role": "system", "content": "You are an assistant that extracts keyphrases from descriptions and names playlists."},
+        {"role": "user", "content": f"""
+        The goal is to create a Spotify playlist based on a given description, using the Spotify API.
+        Generate keyphrases from the given description that can be used to search for existing public playlists on Spotify that would contain the desired songs (songs described by the description).
+        Take time to truly understand what the user wants from the short description. Return accurate keyphrases that would show up in the titles or descriptions of playlists that contain the target songs.
+        Display the keyphrases on the first line, separated by commas with no spaces.
+        On the second line, write "{NAME_MARKER}" followed by one short and effective playlist name that accurately reflects the description. Display nothing else.
+        For example: Description: melodic and euphoric edm music. Your output should look like "euphoric edm,melodic edm" and then "{NAME_MARKER} Euphoria" on the next line. The quotes are there for example, don't include quotes in your answer.
+        If the description is empty or nonsense, simply put none as the keyword and do not write a name. ("none").
+        Keep in mind that each keyphrase is individually used to search spotify for playlists that match the description, so make sure each keyphrase is detailed enough for Spotify's search algorithm to know what you are talking about.
+
+        Description: {desc}
+        """}
+    ]
+
+    start = time.perf_counter()
+    keyphrases = []
+    buffer = ""
+    nameText = None
+    size = 0
+    try:
+        chunks = openai.ChatCompletion.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=300,
+            temperature=0.5,
+            stream=True,
+        )
+        for chunk in chunks:
+            text = chunk["choices"][0].get("delta", {}).get("content") or ""
+            size += len(text.encode())
+            if nameText is not None:
+                nameText += text
+                continue
+            buffer += text
+            # Everything before the first line break is the keyphrase list, everything after it is the name.
+            while True:
+                match = re.search(r"[,\n]", buffer)
+                if match is None:
+                    break
+                keyphrase = buffer[:match.start()].strip()
+                buffer = buffer[match.end():]
+                if keyphrase and keyphrase.lower() != "none":
+                    print(f"Streamed keyphrase after {(time.perf_counter() - start) * 1000:.1f} ms: {keyphrase}")
+                    keyphrases.append(keyphrase)
+                    shared.append(keyphrase)
+                if match.group() == "\n":
+                    nameText = buffer
+                    break
+        recordOutbound("openai", "POST /v1/chat/completions", 200, size, time.perf_counter() - start)
+    except Exception as e:
+        recordOutbound("openai", "POST /v1/chat/completions", "error", size, time.perf_counter() - start)
         print(f"An error occurred: {e}")
-        return None
\ No newline at end of file
+        return
+
+    # The stream ended without a line break, the last keyphrase has no delimiter after it.
+    if nameText is None:
+        keyphrase = buffer.strip()
+        if keyphrase and keyphrase.lower() != "none":
+            keyphrases.append(keyphrase)
+            shared.append(keyphrase)
+    if keyphrases:
+        keyphraseCache.set(key, keyphrases)
+    name = (nameText or "").strip()
+    if name.startswith(NAME_MARKER):
+        name = name[len(NAME_MARKER):].strip()
+    if name and keyphrases:
+        print("GPT Generated Name: ", name)
+        nameCache.set(key, name)
@@ -0,0 +1,115 @@
+# Author: Adrian Simon
+# Bounded-memory track counter using the Space-Saving algorithm (Metwally, Agrawal and El Abbadi, 2005).
+# The exact counters (TrackCounter in aggregation.py and RankingEngine in ranking.py) keep one entry per unique track, which grows
+# with every playlist. This counter keeps at most `capacity` tracks. When a new track arrives and every slot is taken, the track
+# with the lowest count is replaced and the new track inherits that count (plus one), remembering it as its possible error.
+# Guarantees, with N occurrences counted and the smallest tracked count being minCount:
+#   a tracked track's count overestimates its true frequency by at most its own error, and every error is at most minCount <= N / capacity
+#   an untracked track appears at most minCount times, so any track more frequent than N / capacity is always tracked
+# Tracks are kept in buckets of equal count so that counting and replacing are O(1). Only plain frequency counting is supported,
+# like TrackCounter, so RANKING_WEIGHTS does not apply to this backend.
+
+import heapq
+
+from .ranking import encodeOrder
+
+# Number of tracks kept when SPACE_SAVING_CAPACITY is not set in config.py. A few hundred playlists hold far fewer unique tracks
+# than this, so results are usually exact, while memory stays bounded for very large candidate pools.
+DEFAULT_CAPACITY = 20000
+
+class SpaceSavingCounter:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("Space-Saving capacity must be at least 1")
+        self.capacity = capacity
+        # trackID -> [count, error, first seen order]
+        self.entries = {}
+        # count -> {trackID: None}, insertion ordered so the longest-standing track of the lowest count is replaced first
+        self.buckets = {}
+        self.minCount = 0
+        self.total = 0
+
+    def moveToBucket(self, trackID, oldCount, newCount):
+        if oldCount:
+            bucket = self.buckets[oldCount]
+            del bucket[trackID]
+            if not bucket:
+                del self.buckets[oldCount]
+                if oldCount == self.minCount:
+                    self.minCount = newCount
+        self.buckets.setdefault(newCount, {})[trackID] = None
+        if not oldCount and (self.minCount == 0 or newCount < self.minCount):
+            self.minCount = newCount
+
+    # Counts one occurrence of a track. orderKey is any sortable value giving the track's position in a sequential run.
+    def add(self, trackID, orderKey):
+        self.total += 1
+        entry = self.entries.get(trackID)
+        if entry is not None:
+            count = entry[0]
+            entry[0] = count + 1
+            if orderKey < entry[2]:
+                entry[2] = orderKey
+            self.moveToBucket(trackID, count, count + 1)
+            return
+        if len(self.entries) < self.capacity:
+            self.entries[trackID] = [1, 0, orderKey]
+            self.moveToBucket(trackID, 0, 1)
+            return
+        # Replace the track with the lowest count. The new track may have been seen before it was evicted, up to minCount times.
+        minCount = self.minCount
+        bucket = self.buckets[minCount]
+        evicted = next(iter(bucket))
+        del bucket[evicted]
+        del self.entries[evicted]
+        self.entries[trackID] = [minCount + 1, minCount, orderKey]
+        self.buckets.setdefault(minCount + 1, {})[trackID] = None
+        if not bucket:
+            del self.buckets[minCount]
+            self.minCount = minCount + 1
+
+    # Counts every track of a playlist. entries are (trackID, explicit) tuples as returned by fetchPlaylistTracks().
+    # followers is accepted for compatibility with RankingEngine and ignored, every occurrence counts as 1.
+    # With unique=True a track listed several times in the playlist is only counted once (used by the adaptive fetch mode).
+    def addPlaylist(self, entries, playlistOrder, excludeExplicit, followers=None, unique=False):
+        counted = set() if unique else None
+        for position, (trackID, explicit) in enumerate(entries):
+            if not trackID or (excludeExplicit and explicit):
+                continue
+            if counted is not None:
+                if trackID in counted:
+                    continue
+                counted.add(trackID)
+            self.add(trackID, (playlistOrder, position))
+
+    # The most a single track's score can grow by when a playlist is added with unique=True.
+    def maxPlaylistWeight(self, playlistOrder, followers=None):
+        return 1
+
+    # Returns every tracked track as (trackID, estimated frequency, order) tuples, order packed with encodeOrder().
+    # Used by candidate_pool.py.
+    def export(self):
+        return [(trackID, count, encodeOrder(*order)) for trackID, (count, _, order) in self.entries.items()]
+
+    # The most any returned frequency can overestimate the true one. 0 until the counter is full, since nothing was replaced yet.
+    def errorBound(self):
+        return self.minCount if len(self.entries) >= self.capacity else 0
+
+    # Returns the k most frequent tracks as (trackID, frequency) tuples, highest frequency first.
+    # Frequencies are the Space-Saving estimates, see errorBound().
+    def topK(self, k):
+        ranked = heapq.nsmallest(k, self.entries.items(), key=lambda item: (-item[1][0], item[1][2]))
+        return [(trackID, entry[0]) for trackID, entry in ranked]
+
+    # Returns True if the top k is known to be exactly the k most frequent tracks: the k-th track's guaranteed count (estimate
+    # minus error) is at least the estimate of the best track outside the top k, which bounds every other track's frequency.
+    def topKGuaranteed(self, k):
+        ranked = heapq.nsmallest(k + 1, self.entries.items(), key=lambda item: (-item[1][0], item[1][2]))
+        if len(ranked) <= k:
+            return self.errorBound() == 0
+        kthCount, kthError, _ = ranked[k - 1][1]
+        outside = max(ranked[k][1][0], self.errorBound())
+        return kthCount - kthError >= outside
+
+    def stats(self):
+        return {"capacity": self.capacity, "tracked": len(self.entries), "occurrences": self.total, "errorBound": self.errorBound()}
@@ -0,0 +1,344 @@
+# Author: Adrian Simon
+# Background generation jobs for the job mode of /preview_playlist.
+# Instead of holding a gunicorn worker for the whole generation, the POST enqueues the generation into a bounded in-process worker pool
+# and returns right away. The browser then follows the job's progress (polling or Server-Sent Events, see routes.py) and is sent to
+# the playlist preview once the job is done.
+# A job runs in the worker process that accepted it, but its state (status, progress events, result, cancel requests) is kept in a
+# SQLite database in WAL mode shared by every gunicorn worker, like the playlist cache. Status polls, the result page and cancel
+# requests can therefore land on any worker. The store keeps a job's access token only while another worker may need it to delete an
+# abandoned playlist: it is cleared as soon as the job fails, is cancelled, or its result is shown (or never needs deleting). The
+# database is private to the user running the app, like the credential store.
+# Admission control: at most maxWorkers jobs run at once and at most maxQueued more may wait, per worker process. Further jobs are
+# rejected so a burst of users gets a "busy" page instead of piling up behind upstream latency.
+# Cancellation: a cancelled job stops starting new steps, and its temporary playlist is deleted, whether it is still running or it
+# finished but the user never looked at the result. A job that regenerated the playlist already being previewed never deletes it.
+# A cancel request handled by another worker is picked up by the running job within CANCEL_CHECK_INTERVAL. Unclaimed jobs are also
+# cancelled once they expire, which a background thread in every worker checks every JOB_SWEEP_INTERVAL seconds.
+
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .caching import SharedDatabase
+from .executor import PipelineCancelled, StageFailed
+from .spotify import deletePlaylist
+from . import tracing
+
+# Human readable descriptions of the generation stages (see generation.py), shown on the progress page.
+STAGE_MESSAGES = {
+    "keyphrases": "Understanding your description",
+    "userID": "Connecting to Spotify",
+    "tempPlaylist": "Creating your playlist",
+    "tracks": "Finding the most popular tracks",
+    "add": "Adding tracks",
+}
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+FINISHED_MESSAGES = {"done": "Playlist ready", "failed": "Generation failed", "cancelled": "Generation cancelled"}
+
+# Seconds between checks of the job store for a cancel request made through another worker.
+CANCEL_CHECK_INTERVAL = 0.5
+# Seconds between checks of the job store for new events while streaming them.
+EVENT_POLL_INTERVAL = 0.25
+
+# A job as stored in the job store at the time it was read.
+class Job:
+    def __init__(self, row, events):
+        self.id, self.description, self.status, self.playlistID, self.template, self.serverTiming, self.claimed = row
+        self.events = events
+
+    @property
+    def done(self):
+        return self.status in FINISHED_STATUSES
+
+    def toDict(self):
+        return {"id": self.id, "status": self.status, "events": list(self.events)}
+
+# The cancelled flag handed to a running job. Works like a threading.Event for is_set(), and also reports a cancel request stored
+# by another worker, checking the job store at most once every CANCEL_CHECK_INTERVAL.
+class JobCancellation:
+    def __init__(self, manager, jobID):
+        self.manager = manager
+        self.jobID = jobID
+        self.event = threading.Event()
+        self.checked = 0
+
+    def set(self):
+        self.event.set()
+
+    def is_set(self):
+        if self.event.is_set():
+            return True
+        now = time.monotonic()
+        if now - self.checked >= CANCEL_CHECK_INTERVAL:
+            self.checked = now
+            try:
+                if self.manager.cancelRequested(self.jobID):
+                    self.event.set()
+            except sqlite3.Error as e:
+                print(f"Job store read failed: {e}")
+        return self.event.is_set()
+
+# Tables of the job store database.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        access_token TEXT,
+        description TEXT NOT NULL,
+        status TEXT NOT NULL,
+        playlist_id TEXT,
+        owns_playlist INTEGER NOT NULL DEFAULT 1,
+        template TEXT,
+        server_timing TEXT,
+        claimed INTEGER NOT NULL DEFAULT 0,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL,
+        finished REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)",
+    """
+    CREATE TABLE IF NOT EXISTS job_events (
+        job_id TEXT NOT NULL,
+        event TEXT NOT NULL,
+        message TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id)",
+]
+
+class JobManager:
+    def __init__(self, maxWorkers=4, maxQueued=16, ttl=600, sweepInterval=60, path=None):
+        self.maxWorkers = maxWorkers
+        self.maxQueued = maxQueued
+        self.ttl = ttl
+        self.sweepInterval = sweepInterval
+        self.db = SharedDatabase(path, SCHEMA, private=True, name="jamify_jobs.sqlite3")
+        # jobID -> JobCancellation of the jobs queued or running in this process.
+        self.running = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.sweeper = None
+        self.app = None
+
+    # Reads optional overrides from config.py (JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_TTL, JOB_SWEEP_INTERVAL, JOB_STORE_PATH).
+    # Called once from create_app(). Raises PermissionError if the store's file belongs to another user, see SharedDatabase in caching.py.
+    def init_app(self, app):
+        self.app = app
+        self.maxWorkers = app.config.get('JOB_WORKERS', self.maxWorkers)
+        self.maxQueued = app.config.get('JOB_QUEUE_LIMIT', self.maxQueued)
+        self.ttl = app.config.get('JOB_TTL', self.ttl)
+        self.sweepInterval = app.config.get('JOB_SWEEP_INTERVAL', self.sweepInterval)
+        self.db.path = app.config.get('JOB_STORE_PATH', self.db.path)
+        self.db.secure()
+
+    # Returns this thread's connection to the job store, see SharedDatabase in caching.py.
+    def connection(self):
+        return self.db.connection()
+
+    # The pool and the expiry thread are started lazily so that each gunicorn worker process gets its own after forking.
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix="jamify-job")
+            if self.sweeper is None and self.sweepInterval:
+                self.sweeper = threading.Thread(target=self.sweep, name="jamify-job-expiry", daemon=True)
+                self.sweeper.start()
+        return self.executor
+
+    def sweep(self):
+        while True:
+            time.sleep(self.sweepInterval)
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Job expiry failed: {e}")
+
+    # Enqueues a generation. run is called on a worker thread as run(progress, cancelled) and must return the temporary playlist's ID.
+    # ownsPlaylist is False when the job regenerates the playlist being previewed, which is then never deleted by cancelling the job.
+    # Returns the Job, or None if this process's pool and its queue are full.
+    def submit(self, accessToken, description, run, ownsPlaylist=True):
+        executor = self.pool()
+        jobID = secrets.token_urlsafe(16)
+        with self.lock:
+            if len(self.running) >= self.maxWorkers + self.maxQueued:
+                return None
+            cancelled = JobCancellation(self, jobID)
+            self.running[jobID] = cancelled
+        self.connection().execute(
+            "INSERT INTO jobs (id, access_token, description, status, owns_playlist, created) VALUES (?, ?, ?, 'queued', ?, ?)",
+            (jobID, accessToken, description, int(ownsPlaylist), time.time()),
+        )
+        self.publish(jobID, "queued", "Waiting for a free worker")
+        executor.submit(self.execute, jobID, accessToken, run, cancelled, ownsPlaylist)
+        return self.get(jobID)
+
+    # Appends a progress event to a job.
+    def publish(self, jobID, event, message):
+        self.connection().execute("INSERT INTO job_events (job_id, event, message) VALUES (?, ?, ?)", (jobID, event, json.dumps(message)))
+
+    def execute(self, jobID, accessToken, run, cancelled, ownsPlaylist):
+        try:
+            self.runJob(jobID, accessToken, run, cancelled, ownsPlaylist)
+        except Exception as e:
+            print(f"Generation job {jobID} could not be recorded: {e}")
+        finally:
+            with self.lock:
+                self.running.pop(jobID, None)
+
+    def runJob(self, jobID, accessToken, run, cancelled, ownsPlaylist):
+        if cancelled.is_set():
+            self.finish(jobID, "cancelled")
+            return
+
+        def progress(stage):
+            message = STAGE_MESSAGES.get(stage)
+            if message:
+                self.publish(jobID, "progress", message)
+
+        self.connection().execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (jobID,))
+        self.publish(jobID, "running", "Generating playlist")
+        template = None
+        serverTiming = None
+        # Jobs outlive the request that started them, so they run in their own app context with their own trace.
+        with self.app.app_context():
+            token = tracing.startTrace()
+            try:
+                playlistID = run(progress, cancelled)
+            except PipelineCancelled:
+                self.finish(jobID, "cancelled")
+                return
+            except StageFailed as e:
+                template = e.template
+            except Exception as e:
+                print(f"Generation job {jobID} failed: {e}")
+                template = 'error_processing.html'
+            finally:
+                trace = tracing.currentTrace.get()
+                if token is not None and trace is not None:
+                    serverTiming = trace.serverTiming()
+                    tracing.currentTrace.reset(token)
+        if template is not None:
+            self.finish(jobID, "failed", template=template, serverTiming=serverTiming)
+            return
+        # The user may have left while the last step was running, possibly cancelling through another worker. The result is only
+        # stored if no cancel request has been stored by then, otherwise the playlist is deleted right here.
+        if cancelled.is_set() or not self.finish(jobID, "done", playlistID=playlistID, serverTiming=serverTiming, unlessCancelled=True):
+            if playlistID and ownsPlaylist:
+                print(f"Deleting temporary playlist {playlistID} of abandoned job {jobID}")
+                deletePlaylist(accessToken, playlistID)
+            self.finish(jobID, "cancelled")
+
+    # Stores a job's final status. With unlessCancelled nothing is stored if a cancel request came first. Returns whether it was stored.
+    # The access token is cleared unless the job is done with a playlist that cancelling it would still delete.
+    def finish(self, jobID, status, playlistID=None, template=None, serverTiming=None, unlessCancelled=False):
+        cursor = self.connection().execute(
+            "UPDATE jobs SET status = ?, playlist_id = ?, template = ?, server_timing = ?, finished = ?, "
+            "access_token = CASE WHEN ? = 'done' AND owns_playlist = 1 AND ? IS NOT NULL THEN access_token END "
+            "WHERE id = ? AND status IN ('queued', 'running')" + (" AND cancel_requested = 0" if unlessCancelled else ""),
+            (status, playlistID, template, serverTiming, time.time(), status, playlistID, jobID),
+        )
+        if cursor.rowcount == 0:
+            return False
+        self.publish(jobID, status, FINISHED_MESSAGES[status])
+        return True
+
+    def cancelRequested(self, jobID):
+        row = self.connection().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (jobID,)).fetchone()
+        return row is None or bool(row[0])
+
+    # Returns the Job, or None if it does not exist (or has expired).
+    def get(self, jobID):
+        # A worker that only serves status requests still takes part in expiring jobs.
+        self.pool()
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT id, description, status, playlist_id, template, server_timing, claimed FROM jobs WHERE id = ?", (jobID,)
+        ).fetchone()
+        if row is None:
+            return None
+        events = [{"event": event, "message": json.loads(message)}
+                  for event, message in conn.execute("SELECT event, message FROM job_events WHERE job_id = ? ORDER BY rowid", (jobID,))]
+        return Job(row, events)
+
+    # Waits until a job has more than `seen` events or is finished. Returns the job as it is then, or None if it no longer exists.
+    def waitForEvents(self, jobID, seen, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(jobID)
+            if job is None or len(job.events) > seen or job.done or time.monotonic() >= deadline:
+                return job
+            time.sleep(EVENT_POLL_INTERVAL)
+
+    # Cancels a job. A running job stops and rolls back, a finished job that was never shown has its temporary playlist deleted.
+    # Returns False if the job does not exist or has already been shown to the user.
+    def cancel(self, jobID):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT status, claimed, playlist_id, owns_playlist, access_token FROM jobs WHERE id = ?", (jobID,)
+            ).fetchone()
+            if row is None or row[1]:
+                conn.execute("ROLLBACK")
+                return False
+            status, _, playlistID, ownsPlaylist, accessToken = row
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (jobID,))
+            if status == "done":
+                # Taken over here, so the playlist is deleted exactly once.
+                conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', playlist_id = NULL, access_token = NULL, finished = ? WHERE id = ?",
+                    (time.time(), jobID),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        with self.lock:
+            cancelled = self.running.get(jobID)
+        if cancelled is not None:
+            cancelled.set()
+        if status == "done":
+            if playlistID and ownsPlaylist:
+                print(f"Deleting temporary playlist {playlistID} of abandoned job {jobID}")
+                deletePlaylist(accessToken, playlistID)
+            self.publish(jobID, "cancelled", FINISHED_MESSAGES["cancelled"])
+        return True
+
+    # Marks a finished job as shown to the user, after which cancelling it no longer deletes its playlist.
+    def claim(self, job):
+        cursor = self.connection().execute(
+            "UPDATE jobs SET claimed = 1, access_token = NULL WHERE id = ? AND status = 'done' AND cancel_requested = 0", (job.id,)
+        )
+        return cursor.rowcount == 1
+
+    # Cancels jobs older than the TTL that were never shown, and forgets them once they are finished. Jobs whose worker died
+    # before finishing are forgotten after twice the TTL.
+    def expire(self):
+        now = time.time()
+        conn = self.connection()
+        expired = [row[0] for row in conn.execute(
+            "SELECT id FROM jobs WHERE created < ? AND claimed = 0 AND status IN ('queued', 'running', 'done') AND cancel_requested = 0", (now - self.ttl,)
+        )]
+        for jobID in expired:
+            self.cancel(jobID)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            stale = "created < ? AND (status IN ('done', 'failed', 'cancelled') OR created < ?)"
+            conn.execute(f"DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE {stale})", (now - self.ttl, now - 2 * self.ttl))
+            conn.execute(f"DELETE FROM jobs WHERE {stale}", (now - self.ttl, now - 2 * self.ttl))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        if expired:
+            print(f"Expired {len(expired)} generation jobs")
+
+# Single job manager for this process. Other processes share the jobs through the SQLite file.
+jobManager = JobManager()
@@ -0,0 +1,206 @@
+# Author: Adrian Simon
+# Cache of playlist contents that sits in front of the playlist track fetch in spotify.py.
+# Popular public playlists come back for many different descriptions, so their tracks are stored and reused instead of being refetched.
+# Entries are keyed by playlist ID and are only used while their snapshot_id matches the one Spotify returned in the search results
+# (Spotify changes the snapshot_id whenever a playlist is modified), so a hit can never serve stale contents.
+# Playlists found without a snapshot_id (served from the playlist corpus, see playlist_corpus.py) are stored with an empty one and
+# can be served any entry of the playlist fetched within a freshness bound instead, which the caller chooses.
+# The cache is a SQLite database in WAL mode, which lets every gunicorn worker on a dyno share it.
+# Track IDs are stored compactly: each 22 character base62 ID is decoded into a 17 byte integer and explicit flags are packed into a bitmap.
+# Local files (entries without an ID) keep their position as a LOCAL_FILE placeholder, so an entry covering more pages than a request
+# asks for can be cut to exactly the tracks those pages hold.
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .caching import SharedDatabase
+
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE62_INDEX = {c: i for i, c in enumerate(BASE62)}
+TRACK_ID_LENGTH = 22
+# 62^22 needs 131 bits, so every decoded ID fits in 17 bytes.
+TRACK_ID_BYTES = 17
+# Stored in place of a local file. Larger than any decoded ID, since 62^22 < 2^136.
+LOCAL_FILE = b"\xff" * TRACK_ID_BYTES
+# Tracks per page of a playlist's tracks, the most Spotify returns per request.
+TRACK_PAGE_SIZE = 100
+
+# Eviction is checked once every EVICTION_INTERVAL writes rather than on every write.
+EVICTION_INTERVAL = 32
+
+# Decodes a base62 Spotify ID into bytes. Returns None for anything that is not a valid Spotify ID.
+def decodeTrackID(trackID):
+    if not trackID or len(trackID) != TRACK_ID_LENGTH:
+        return None
+    value = 0
+    for c in trackID:
+        digit = BASE62_INDEX.get(c)
+        if digit is None:
+            return None
+        value = value * 62 + digit
+    return value.to_bytes(TRACK_ID_BYTES, "big")
+
+# Encodes bytes produced by decodeTrackID back into a base62 Spotify ID.
+def encodeTrackID(data):
+    value = int.from_bytes(data, "big")
+    chars = []
+    for _ in range(TRACK_ID_LENGTH):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62[digit])
+    return "".join(reversed(chars))
+
+# Packs a list of (trackID, explicit) tuples into an ID blob and an explicit bitmap.
+# Entries without an ID (local files) are stored as LOCAL_FILE.
+# Returns None if any other track ID cannot be decoded, in which case the playlist is simply not cached.
+def packEntries(entries):
+    ids = bytearray()
+    flags = bytearray((len(entries) + 7) // 8)
+    for i, (trackID, explicit) in enumerate(entries):
+        if trackID is None:
+            ids += LOCAL_FILE
+            continue
+        decoded = decodeTrackID(trackID)
+        if decoded is None:
+            return None
+        ids += decoded
+        if explicit:
+            flags[i // 8] |= 1 << (i % 8)
+    return bytes(ids), bytes(flags)
+
+# Reverses packEntries() for the first limit entries (all of them if limit is None). Local files are left out since they are never counted.
+def unpackEntries(ids, flags, limit=None):
+    count = len(ids) // TRACK_ID_BYTES
+    if limit is not None:
+        count = min(count, limit)
+    entries = []
+    for i in range(count):
+        data = ids[i * TRACK_ID_BYTES:(i + 1) * TRACK_ID_BYTES]
+        if data == LOCAL_FILE:
+            continue
+        explicit = bool(flags[i // 8] & (1 << (i % 8)))
+        entries.append((encodeTrackID(data), explicit))
+    return entries
+
+# Tables of the playlist cache database.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS playlists (
+        id TEXT PRIMARY KEY,
+        snapshot_id TEXT NOT NULL,
+        track_ids BLOB NOT NULL,
+        explicit BLOB NOT NULL,
+        pages INTEGER NOT NULL,
+        complete INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        last_used REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS playlists_last_used ON playlists (last_used)",
+]
+
+class PlaylistCache:
+    def __init__(self, path=None, maxEntries=20000, ttl=7 * 24 * 3600, enabled=True):
+        self.db = SharedDatabase(path or os.path.join(tempfile.gettempdir(), "jamify_playlist_cache.sqlite3"), SCHEMA)
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    # Reads optional overrides from config.py. Called once from create_app().
+    def init_app(self, app):
+        config = app.config
+        self.db.path = config.get('PLAYLIST_CACHE_PATH', self.db.path)
+        self.maxEntries = config.get('PLAYLIST_CACHE_MAX_ENTRIES', self.maxEntries)
+        self.ttl = config.get('PLAYLIST_CACHE_TTL', self.ttl)
+        self.enabled = config.get('PLAYLIST_CACHE_ENABLED', self.enabled)
+
+    # Returns this thread's connection to the cache database, see SharedDatabase in caching.py.
+    def connection(self):
+        return self.db.connection()
+
+    # Returns the cached (trackID, explicit) list for a playlist, or None on a miss.
+    # An entry is only a hit if its snapshot_id matches, it is younger than the TTL, and it covers at least maxPages pages
+    # (or the whole playlist), so changing SPOTIFY_MAX_TRACK_PAGES never serves a truncated playlist. An entry covering more pages is
+    # cut to the tracks of the first maxPages pages, the same tracks a fetch of maxPages pages returns.
+    # Without a snapshotID, any entry of the playlist younger than maxAge seconds is a hit, and nothing is without maxAge.
+    def get(self, playlistID, snapshotID, maxPages, maxAge=None):
+        if not self.enabled or not (snapshotID or maxAge):
+            return None
+        now = time.time()
+        try:
+            conn = self.connection()
+            if snapshotID:
+                row = conn.execute(
+                    "SELECT track_ids, explicit, pages, complete, fetched_at FROM playlists WHERE id = ? AND snapshot_id = ?",
+                    (playlistID, snapshotID),
+                ).fetchone()
+                maxAge = self.ttl
+            else:
+                row = conn.execute(
+                    "SELECT track_ids, explicit, pages, complete, fetched_at FROM playlists WHERE id = ?", (playlistID,)
+                ).fetchone()
+                maxAge = min(maxAge, self.ttl)
+            if row is None or now - row[4] > maxAge or not (row[3] or row[2] >= maxPages):
+                with self.lock:
+                    self.misses += 1
+                return None
+            conn.execute("UPDATE playlists SET last_used = ? WHERE id = ?", (now, playlistID))
+        except sqlite3.Error as e:
+            print(f"Playlist cache read failed: {e}")
+            return None
+        with self.lock:
+            self.hits += 1
+        return unpackEntries(row[0], row[1], maxPages * TRACK_PAGE_SIZE)
+
+    # Stores the tracks of a playlist. pages is the number of pages that were fetched and complete says whether the whole playlist was read.
+    # snapshotID may be None, see get().
+    def put(self, playlistID, snapshotID, entries, pages, complete):
+        if not self.enabled:
+            return
+        packed = packEntries(entries)
+        if packed is None:
+            return
+        now = time.time()
+        try:
+            conn = self.connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO playlists (id, snapshot_id, track_ids, explicit, pages, complete, fetched_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (playlistID, snapshotID or "", packed[0], packed[1], pages, int(complete), now, now),
+            )
+            with self.lock:
+                self.writes += 1
+                evict = self.writes % EVICTION_INTERVAL == 0
+            if evict:
+                self.evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"Playlist cache write failed: {e}")
+
+    # Drops expired entries, then the least recently used entries until the cache is back under maxEntries.
+    def evict(self, conn, now):
+        conn.execute("DELETE FROM playlists WHERE fetched_at < ?", (now - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM playlists").fetchone()[0]
+        if count > self.maxEntries:
+            conn.execute(
+                "DELETE FROM playlists WHERE id IN (SELECT id FROM playlists ORDER BY last_used LIMIT ?)",
+                (count - self.maxEntries,),
+            )
+
+    # Hit/miss counters for this process.
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+# Single cache shared by every request in this process. Other processes share it through the SQLite file.
+playlistCache = PlaylistCache()
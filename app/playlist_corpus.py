@@ -0,0 +1,239 @@
+# Author: Adrian Simon
+# Local corpus of the playlist metadata Spotify has returned to keyphrase searches, with a full-text index to answer searches from.
+# Every successful /v1/search response is added to the corpus (ID, name, description, snapshot_id, owner). The name and description
+# are indexed with SQLite FTS5 and the playlists each keyphrase returned are recorded, so a later search can be answered locally:
+# searchKeyphrase() in spotify.py asks the corpus first and only calls Spotify when the corpus does not have enough fresh coverage
+# for the keyphrase. A search is answered with the playlists Spotify returned for the same keyphrase if there are enough of them,
+# otherwise with the best full-text matches (playlists whose name or description contain every word of the keyphrase). Either way
+# at least minMatches playlists seen within the TTL are needed.
+# Every keyphrase asked for is also counted, so the warm-up job (warmup.py) knows which keyphrases are the most common.
+# Playlists served from the corpus carry no snapshot_id: the stored one may be days old, and the playlist cache (playlist_cache.py)
+# relies on it to never serve stale tracks. Their tracks come from any playlist cache entry fetched within the corpus TTL instead, so
+# they are as fresh as the corpus itself. The corpus changes which playlists a keyphrase finds, so it is off unless
+# CORPUS_ENABLED = True in config.py. It is meant for when search requests are the bottleneck (e.g. rate limits on /v1/search).
+# Like the playlist cache the corpus is a SQLite database in WAL mode shared by every gunicorn worker.
+# If the SQLite build has no FTS5, the corpus turns itself off and every search goes to Spotify as before. Any other database error
+# (e.g. a lock held by another worker) only makes that one search a miss.
+
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .caching import SharedDatabase
+
+# Tables of the corpus database. corpus_fts is a standalone FTS table kept in sync by add(), its rowid is the playlist's rowid in
+# corpus_playlists.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS corpus_playlists (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        snapshot_id TEXT,
+        owner_id TEXT,
+        owner_name TEXT,
+        seen_at REAL NOT NULL
+    )
+    """,
+    "CREATE VIRTUAL TABLE IF NOT EXISTS corpus_fts USING fts5(name, description, tokenize = 'unicode61 remove_diacritics 2')",
+    """
+    CREATE TABLE IF NOT EXISTS corpus_results (
+        query TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        playlist_id TEXT NOT NULL,
+        PRIMARY KEY (query, position)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS corpus_queries (
+        query TEXT PRIMARY KEY,
+        uses INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        last_searched REAL
+    )
+    """,
+]
+
+class PlaylistCorpus:
+    def __init__(self, path=None, ttl=3 * 24 * 3600, minMatches=None, enabled=False):
+        self.db = SharedDatabase(path or os.path.join(tempfile.gettempdir(), "jamify_playlist_corpus.sqlite3"), SCHEMA)
+        self.ttl = ttl
+        # Fresh matches needed to answer a search locally. None means as many as the search asks for.
+        self.minMatches = minMatches
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Reads optional overrides from config.py (CORPUS_PATH, CORPUS_TTL, CORPUS_MIN_MATCHES, CORPUS_ENABLED). Called once from create_app().
+    def init_app(self, app):
+        config = app.config
+        self.db.path = config.get('CORPUS_PATH', self.db.path)
+        self.ttl = config.get('CORPUS_TTL', self.ttl)
+        self.minMatches = config.get('CORPUS_MIN_MATCHES', self.minMatches)
+        self.enabled = config.get('CORPUS_ENABLED', self.enabled)
+
+    # Returns this thread's connection to the corpus database, see SharedDatabase in caching.py.
+    def connection(self):
+        try:
+            return self.db.connection()
+        except sqlite3.OperationalError as e:
+            if "fts5" in str(e):
+                # This SQLite build has no full-text search, so the corpus can never answer a search.
+                print(f"Playlist corpus disabled, SQLite has no FTS5: {e}")
+                self.enabled = False
+            raise
+
+    # Turns an arbitrary keyphrase into an FTS5 query matching every word of it. Returns None if it has no words.
+    @staticmethod
+    def ftsQuery(keyphrase):
+        words = re.findall(r"\w+", keyphrase.lower())
+        if not words:
+            return None
+        return " ".join(f'"{word}"' for word in words)
+
+    # Returns up to limit playlists for a keyphrase in the same format as Spotify's search results, best match first, or None if
+    # the corpus cannot answer it and Spotify should be asked. snapshot_id is left out, see the top of this file.
+    def search(self, keyphrase, limit):
+        if not self.enabled:
+            return None
+        query = self.ftsQuery(keyphrase)
+        if query is None:
+            return None
+        normalized = normalizeKeyphrase(keyphrase)
+        now = time.time()
+        needed = self.minMatches or limit
+        try:
+            conn = self.connection()
+            conn.execute(
+                "INSERT INTO corpus_queries (query, uses, last_used) VALUES (?, 1, ?) "
+                "ON CONFLICT(query) DO UPDATE SET uses = uses + 1, last_used = excluded.last_used",
+                (normalized, now),
+            )
+            rows = conn.execute(
+                "SELECT p.id, p.name, p.description, p.owner_id, p.owner_name FROM corpus_results r "
+                "JOIN corpus_playlists p ON p.id = r.playlist_id "
+                "WHERE r.query = ? AND p.seen_at > ? ORDER BY r.position LIMIT ?",
+                (normalized, now - self.ttl, max(needed, limit)),
+            ).fetchall()
+            if len(rows) < needed:
+                rows = conn.execute(
+                    "SELECT p.id, p.name, p.description, p.owner_id, p.owner_name FROM corpus_fts "
+                    "JOIN corpus_playlists p ON p.rowid = corpus_fts.rowid "
+                    "WHERE corpus_fts MATCH ? AND p.seen_at > ? ORDER BY bm25(corpus_fts) LIMIT ?",
+                    (query, now - self.ttl, max(needed, limit)),
+                ).fetchall()
+        except sqlite3.Error as e:
+            # E.g. "database is locked" while another worker writes, the search simply goes to Spotify this time.
+            print(f"Playlist corpus search failed, searching Spotify instead: {e}")
+            rows = []
+        if len(rows) < needed:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return [
+            {
+                "id": playlistID,
+                "name": name,
+                "description": description,
+                "snapshot_id": None,
+                "owner": {"id": ownerID, "display_name": ownerName},
+            }
+            for playlistID, name, description, ownerID, ownerName in rows[:limit]
+        ]
+
+    # Adds the playlists Spotify returned for a keyphrase to the corpus and records them, in order, as the keyphrase's results.
+    def add(self, keyphrase, playlists):
+        if not self.enabled:
+            return
+        normalized = normalizeKeyphrase(keyphrase)
+        now = time.time()
+        conn = None
+        try:
+            conn = self.connection()
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM corpus_results WHERE query = ?", (normalized,))
+            position = 0
+            for p in playlists:
+                # Spotify sometimes returns "null data" in search results, see streamPotentialTracks().
+                if not isinstance(p, dict) or not p.get("id"):
+                    continue
+                owner = p.get("owner") or {}
+                name = p.get("name") or ""
+                description = p.get("description") or ""
+                row = conn.execute("SELECT rowid FROM corpus_playlists WHERE id = ?", (p["id"],)).fetchone()
+                if row is None:
+                    cursor = conn.execute(
+                        "INSERT INTO corpus_playlists (id, name, description, snapshot_id, owner_id, owner_name, seen_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (p["id"], name, description, p.get("snapshot_id"), owner.get("id"), owner.get("display_name"), now),
+                    )
+                    conn.execute("INSERT INTO corpus_fts (rowid, name, description) VALUES (?, ?, ?)", (cursor.lastrowid, name, description))
+                else:
+                    conn.execute(
+                        "UPDATE corpus_playlists SET name = ?, description = ?, snapshot_id = ?, owner_id = ?, owner_name = ?, seen_at = ? "
+                        "WHERE rowid = ?",
+                        (name, description, p.get("snapshot_id"), owner.get("id"), owner.get("display_name"), now, row[0]),
+                    )
+                    conn.execute("UPDATE corpus_fts SET name = ?, description = ? WHERE rowid = ?", (name, description, row[0]))
+                conn.execute("INSERT INTO corpus_results (query, position, playlist_id) VALUES (?, ?, ?)", (normalized, position, p["id"]))
+                position += 1
+            conn.execute(
+                "INSERT INTO corpus_queries (query, uses, last_used, last_searched) VALUES (?, 0, ?, ?) "
+                "ON CONFLICT(query) DO UPDATE SET last_searched = excluded.last_searched",
+                (normalized, now, now),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Playlist corpus write failed: {e}")
+            if conn is not None and conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+    # Returns the count most used keyphrases that have not been searched on Spotify within maxAge seconds.
+    def staleKeyphrases(self, count, maxAge):
+        if not self.enabled:
+            return []
+        try:
+            rows = self.connection().execute(
+                "SELECT query FROM corpus_queries WHERE last_searched IS NULL OR last_searched < ? ORDER BY uses DESC LIMIT ?",
+                (time.time() - maxAge, count),
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Playlist corpus read failed: {e}")
+            return []
+        return [row[0] for row in rows]
+
+    # Returns True if a keyphrase has not been searched on Spotify within maxAge seconds.
+    def needsRefresh(self, keyphrase, maxAge):
+        if not self.enabled:
+            return False
+        try:
+            row = self.connection().execute(
+                "SELECT last_searched FROM corpus_queries WHERE query = ?", (normalizeKeyphrase(keyphrase),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Playlist corpus read failed: {e}")
+            return False
+        return row is None or row[0] is None or row[0] < time.time() - maxAge
+
+    # Hit/miss counters for this process.
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+# Keyphrases are counted case and whitespace insensitively.
+def normalizeKeyphrase(keyphrase):
+    return re.sub(r"\s+", " ", keyphrase.lower()).strip()
+
+# Single corpus shared by every request in this process. Other processes share it through the SQLite file.
+playlistCorpus = PlaylistCorpus()
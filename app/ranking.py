@@ -0,0 +1,150 @@
+# Author: Adrian Simon
+# NumPy-backed ranking engine, a drop-in replacement for TrackCounter (aggregation.py) + topKMostFrequentTracks() (spotify.py).
+# Track IDs are interned to integer codes as they arrive and each playlist is stored as one array of codes, instead of updating
+# a dictionary of 22 character strings for every occurrence. Scores are computed in one pass with np.bincount and the top-k is selected with np.argpartition,
+# which keeps ranking cheap even with hundreds of thousands of candidate tracks.
+#
+# Every occurrence can be weighted. With the default weights every occurrence counts as 1, i.e. plain frequency counting.
+#   keyphraseDecay: weight 1 / (1 + decay * keyphrase index), earlier keyphrases from OpenAI count more
+#   playlistDecay:  weight 1 / (1 + decay * position of the playlist in the search results)
+#   trackDecay:     weight 1 / (1 + decay * position of the track inside the playlist)
+#   followerScale:  weight 1 + scale * log10(1 + followers), only applied when the playlist's follower count is known
+# Ties are broken by the position at which a sequential run would first have seen the track, so results never depend on fetch timing.
+
+import math
+
+import numpy as np
+
+DEFAULT_WEIGHTS = {
+    "keyphraseDecay": 0.0,
+    "playlistDecay": 0.0,
+    "trackDecay": 0.0,
+    "followerScale": 0.0,
+}
+
+# Orders are packed into one int64: 20 bits each for the keyphrase index, search result index and track position.
+ORDER_BITS = 20
+ORDER_MASK = (1 << ORDER_BITS) - 1
+
+# Packs a (keyphrase index, search result index) playlist order and a track position into a sortable integer.
+def encodeOrder(playlistOrder, position):
+    keyphraseIndex, playlistIndex = playlistOrder
+    return (((keyphraseIndex << ORDER_BITS) | (playlistIndex & ORDER_MASK)) << ORDER_BITS) | (position & ORDER_MASK)
+
+class RankingEngine:
+    def __init__(self, weights=None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.weighted = any(self.weights.values())
+        self.codes = {}
+        self.ids = []
+        # Occurrences are kept as one chunk of NumPy arrays per playlist and concatenated once in topK().
+        self.codeChunks = []
+        self.orderChunks = []
+        self.scoreChunks = []
+
+    # Returns the integer code for a track ID, assigning a new one the first time the ID is seen.
+    def intern(self, trackID):
+        code = self.codes.get(trackID)
+        if code is None:
+            code = len(self.ids)
+            self.codes[trackID] = code
+            self.ids.append(trackID)
+        return code
+
+    # Counts one occurrence of a track. orderKey is a ((keyphrase index, search result index), position) tuple.
+    # weight is only used when weights are configured, otherwise every occurrence counts as 1.
+    def add(self, trackID, orderKey, weight=1.0):
+        playlistOrder, position = orderKey
+        self.codeChunks.append(np.array([self.intern(trackID)], dtype=np.int64))
+        self.orderChunks.append(np.array([encodeOrder(playlistOrder, position)], dtype=np.int64))
+        self.scoreChunks.append(np.array([weight], dtype=np.float64))
+
+    # Weight shared by every track of a playlist.
+    def playlistWeight(self, playlistOrder, followers):
+        keyphraseIndex, playlistIndex = playlistOrder
+        weight = 1.0 / (1.0 + self.weights["keyphraseDecay"] * keyphraseIndex)
+        weight /= 1.0 + self.weights["playlistDecay"] * playlistIndex
+        if followers is not None:
+            weight *= 1.0 + self.weights["followerScale"] * math.log10(1 + followers)
+        return weight
+
+    # Counts every track of a playlist. entries are (trackID, explicit) tuples as returned by fetchPlaylistTracks().
+    # playlistOrder is (keyphrase index, search result index). followers is the playlist's follower count, if known.
+    # The only per-track Python work is interning the ID, orders and weights are computed for the whole playlist at once.
+    # With unique=True a track listed several times in the playlist is only counted once, at its first position.
+    def addPlaylist(self, entries, playlistOrder, excludeExplicit, followers=None, unique=False):
+        codes = self.codes
+        ids = self.ids
+        playlistCodes = []
+        positions = []
+        counted = set() if unique else None
+        for position, (trackID, explicit) in enumerate(entries):
+            if not trackID or (excludeExplicit and explicit):
+                continue
+            code = codes.get(trackID)
+            if code is None:
+                code = len(ids)
+                codes[trackID] = code
+                ids.append(trackID)
+            elif counted is not None and code in counted:
+                continue
+            if counted is not None:
+                counted.add(code)
+            playlistCodes.append(code)
+            positions.append(position)
+        if not playlistCodes:
+            return
+        positions = np.array(positions, dtype=np.int64)
+        self.codeChunks.append(np.array(playlistCodes, dtype=np.int64))
+        self.orderChunks.append(encodeOrder(playlistOrder, 0) | (positions & ORDER_MASK))
+        if self.weighted:
+            weights = self.playlistWeight(playlistOrder, followers) / (1.0 + self.weights["trackDecay"] * positions)
+            self.scoreChunks.append(weights)
+
+    # The most a single track's score can grow by when a playlist is added with unique=True.
+    # Track position weights are at most 1, so this is the playlist's own weight.
+    def maxPlaylistWeight(self, playlistOrder, followers=None):
+        return self.playlistWeight(playlistOrder, followers) if self.weighted else 1
+
+    # Returns every track's score and first-seen order (packed with encodeOrder()) as two arrays indexed by track code.
+    def totals(self):
+        n = len(self.ids)
+        codes = np.concatenate(self.codeChunks)
+        if self.weighted:
+            scores = np.bincount(codes, weights=np.concatenate(self.scoreChunks), minlength=n)
+        else:
+            scores = np.bincount(codes, minlength=n)
+        firstSeen = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(firstSeen, codes, np.concatenate(self.orderChunks))
+        return scores, firstSeen
+
+    # Returns every counted track as (trackID, score, order) tuples, order packed with encodeOrder(). Used by candidate_pool.py.
+    def export(self):
+        if not self.ids:
+            return []
+        scores, firstSeen = self.totals()
+        return list(zip(self.ids, scores.tolist(), firstSeen.tolist()))
+
+    # Scores are exact.
+    def errorBound(self):
+        return 0
+
+    # Returns the k highest scoring tracks as (trackID, score) tuples, highest score first.
+    # Scores are integer frequencies when no weights are configured and floats otherwise.
+    def topK(self, k):
+        n = len(self.ids)
+        if n == 0 or k <= 0:
+            return []
+        scores, firstSeen = self.totals()
+
+        if k < n:
+            # Everything tied with the k-th best score is kept as a candidate so the tie-break below decides who makes the cut.
+            threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+            candidates = np.flatnonzero(scores >= threshold)
+        else:
+            candidates = np.arange(n)
+        ranked = candidates[np.lexsort((firstSeen[candidates], -scores[candidates]))][:k]
+        convert = float if self.weighted else int
+        return [(self.ids[code], convert(scores[code])) for code in ranked]
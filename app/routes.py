@@ -2,18 +2,47 @@
 # File for handling routes of the application, essentially the brains of the application.
 # Connects all pages and scripts together.
 
-from flask import Blueprint, redirect, request, session, url_for, current_app, render_template
-from .spotify import getPotentialTracks, searchForPlaylists, getTokenFromCode, getUserID, createTempPlaylist, addTracksToPlaylist, updatePlaylist, deletePlaylist
-from .gpt_integration import generateKeyphrases, generatePlaylistName
+import json
+
+from flask import Blueprint, Response, abort, g, jsonify, redirect, request, session, url_for, current_app, render_template
+from .spotify import getTokenFromCode, updatePlaylist, deletePlaylist
+from .gpt_integration import generatePlaylistName
+from .executor import StageFailed
+from .generation import generatePreview
+from .candidate_pool import candidatePools
+from .credentials import credentials
+from .jobs import jobManager
+from . import tracing
 from flask_mail import Mail, Message
 
 # Initialization of blueprint and mail object. Mail object is used for whitelist requests.
 bp = Blueprint('routes', __name__)
 mail = Mail()
 
+# Largest playlist that can be requested when MAX_PLAYLIST_SIZE is not set in config.py. Tracks are written 100 per request
+# (see writePlaylistTracks() in spotify.py), so this takes 10 writes.
+DEFAULT_MAX_PLAYLIST_SIZE = 1000
+
 def init_mail(app):
     mail.init_app(app)
 
+# Starts a trace for every request so the stages of playlist generation can be timed (see tracing.py).
+@bp.before_request
+def start_trace():
+    g.trace_token = tracing.startTrace()
+
+# Adds the Server-Timing header with the stage timings of the request.
+@bp.after_request
+def finish_trace(response):
+    return tracing.finishTrace(g.pop('trace_token', None), response, request.endpoint)
+
+# Prometheus-style metrics (stage and outbound request histograms) for this worker process.
+@bp.route('/metrics')
+def metrics():
+    if not tracing.enabled:
+        abort(404)
+    return Response(tracing.renderMetrics(), mimetype='text/plain; version=0.0.4')
+
 # Default route (home page where users are prompted to log in).
 @bp.route('/')
 def home():
@@ -39,79 +68,180 @@ def login():
     )
     return redirect(authURL)
 
-# Logout route. Clears session data and redirects to home page.
+# Logout route. Clears session data (including the stored Spotify credentials) and redirects to home page.
 @bp.route('/logout')
 def logout():
+    credentials.forget()
     session.clear()
     return redirect(url_for('routes.home'))
 
 # Callback route, gets called by Spotify after login is successful.
+# The access token and the user's Spotify ID are kept in the session, the refresh token server side (see credentials.py).
 @bp.route('/callback')
 def callback():
     code = request.args.get('code')
-    token = getTokenFromCode(code)
-    session['access_token'] = token
+    tokenData = getTokenFromCode(code)
+    if tokenData is None:
+        return redirect(url_for('routes.home'))
+    credentials.login(tokenData)
     return redirect(url_for('routes.create_playlist'))
 
 @bp.route('/create_playlist', methods=['GET'])
 def create_playlist():
-    return render_template('playlist_input.html')
+    return render_template('playlist_input.html', maxSize=current_app.config.get('MAX_PLAYLIST_SIZE', DEFAULT_MAX_PLAYLIST_SIZE))
 
 # Critical function.
 # Fetches user inputs from front end, processes description by extracting keyphrases through gpt_integration.py,
-# calls all neccessary functions in spotify.py, and generates/displays a playlist for the user.
+# calls all neccessary functions in spotify.py (through the concurrent pipeline in generation.py), and generates/displays a playlist for the user.
 # Includes robust error handling with redirection to custom error pages for each possible error case.
 # Returns redirection to the playlist preview page, passing playlist id and description to the page.
 @bp.route('/preview_playlist', methods=['POST'])
 def preview_playlist():
     description = request.form.get('playlistDescription')
-    numSongs = int(request.form.get('playlistSize'))
+    numSongs = max(1, min(int(request.form.get('playlistSize')), current_app.config.get('MAX_PLAYLIST_SIZE', DEFAULT_MAX_PLAYLIST_SIZE)))
     excludeExplicit = request.form.get('excludeExplicit') == 'on'
 
-    accessToken = session.get('access_token')
+    accessToken = credentials.currentAccessToken()
     if accessToken is None:
         print("Access token missing")
         return redirect(url_for('routes.login'))
-    
-    keywords = generateKeyphrases(description)
-    if keywords == ["none"]:
-        print("No keyphrases generated.")
-        return render_template('error_processing.html')
 
-    userID = getUserID(accessToken)
-    playlistID = createTempPlaylist(accessToken, userID)
-    if playlistID == "whitelist needed":
-        return render_template('whitelist_form.html')
-    if not playlistID:
-        return render_template('error_spotify_create.html')
-
-    playlists = searchForPlaylists(accessToken, keywords)
-    if playlists is None:
-        playlist_id = request.args.get('id')
-        access_token = session.get('access_token')
-    
-        if access_token and playlist_id:
-            deletePlaylist(access_token, playlist_id)
-        return render_template('error_spotify_fetch.html')
-
-    tracks = getPotentialTracks(accessToken, playlists, numSongs, excludeExplicit)
-    if tracks is None:
-        playlist_id = request.args.get('id')
-        access_token = session.get('access_token')
-    
-        if access_token and playlist_id:
-            deletePlaylist(access_token, playlist_id)
-        return render_template('error_spotify_fetch.html')
-    
-    print("Tracks generated:", tracks)
-    trackURIs = [f"spotify:track:{track}" for track in tracks]
-    addTracksToPlaylist(accessToken, playlistID, trackURIs)
+    return startPreview(accessToken, description, numSongs, excludeExplicit)
+
+# "More like this": generates a new playlist for the description extended with the user's addition, replacing the tracks of the
+# previewed playlist. Only the keyphrases of the addition that are new are searched, the rest of the candidates come from the
+# session's candidate pool.
+@bp.route('/more_like_this', methods=['POST'])
+def more_like_this():
+    accessToken = credentials.currentAccessToken()
+    if accessToken is None:
+        return redirect(url_for('routes.login'))
+
+    pool = candidatePools.get(session.get('pool_id'))
+    description = pool.description if pool else session.get('playlist_description')
+    addition = (request.form.get('addition') or '').strip()
+    if not description:
+        return redirect(url_for('routes.create_playlist'))
+    if addition:
+        description = f"{description}, {addition}"
+
+    # Only the session's own preview playlist is regenerated in place. Any other playlist ID is ignored (it may not even be a
+    # Jamify playlist) and a new temporary playlist is created.
+    playlist_id = request.form.get('playlist_id')
+    if playlist_id and playlist_id != session.get('playlist_id'):
+        print(f"Ignoring playlist {playlist_id}, it is not the playlist being previewed")
+        playlist_id = None
+    return startPreview(accessToken, description, session.get('playlist_size', 30), session.get('exclude_explicit', False), refine=True,
+                        playlistID=playlist_id)
+
+# Starts a generation for preview_playlist and more_like_this, in the background (job mode) or within the request.
+# The session's candidate pool is reused when the description is the same or when refining, otherwise a new pool is started.
+# playlistID is an existing temporary playlist to regenerate into (see generatePreview()).
+def startPreview(accessToken, description, numSongs, excludeExplicit, refine=False, playlistID=None):
+    pool = candidatePools.get(session.get('pool_id'))
+    if pool is None or (pool.description != description and not refine):
+        pool = candidatePools.create(description)
+        session['pool_id'] = pool.id if pool else None
+    session['playlist_size'] = numSongs
+    session['exclude_explicit'] = excludeExplicit
+    userID = credentials.userID()
+
+    # Job mode: run the generation in the background worker pool and send the user to the progress page right away.
+    if request.form.get('mode') == 'job' or current_app.config.get('PREVIEW_JOB_MODE', False):
+        def run(progress, cancelled):
+            return generatePreview(accessToken, description, numSongs, excludeExplicit, progress=progress, cancelled=cancelled, pool=pool,
+                                   playlistID=playlistID, userID=userID)
+
+        job = jobManager.submit(accessToken, description, run, ownsPlaylist=playlistID is None)
+        if job is None:
+            print("Job queue full, rejecting generation request")
+            return render_template('error_busy.html'), 503
+        session['job_id'] = job.id
+        return redirect(url_for('routes.job_progress', job_id=job.id))
+
+    try:
+        playlistID = generatePreview(accessToken, description, numSongs, excludeExplicit, pool=pool, playlistID=playlistID, userID=userID)
+    except StageFailed as e:
+        return render_template(e.template)
+    except Exception as e:
+        # Same fallback as a generation job (jobs.py), the temporary playlist has already been rolled back.
+        print(f"Generation failed: {e}")
+        return render_template('error_processing.html')
 
     print(f"Generated playlist ID: {playlistID}")
     session['playlist_description'] = description
     session['playlist_id'] = playlistID
     return render_template('playlist_preview.html', playlistID=playlistID, description=description)
 
+# Returns the generation job with the given ID if it belongs to the current session, otherwise responds with 404.
+def sessionJob(job_id):
+    job = jobManager.get(job_id)
+    if job is None or session.get('job_id') != job_id:
+        abort(404)
+    return job
+
+# Progress page for a generation job.
+@bp.route('/jobs/<job_id>')
+def job_progress(job_id):
+    sessionJob(job_id)
+    return render_template('job_progress.html', job_id=job_id)
+
+# Job status and progress events as JSON, polled by the progress page.
+@bp.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    return jsonify(sessionJob(job_id).toDict())
+
+# Job progress as Server-Sent Events. Each event is sent as soon as it happens and the stream ends when the job is finished.
+# This keeps a connection open for the whole generation, so it is meant for threaded/async servers. The progress page polls instead.
+@bp.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = sessionJob(job_id)
+
+    def stream():
+        seen = 0
+        while True:
+            current = jobManager.waitForEvents(job.id, seen, timeout=15)
+            if current is None:
+                return
+            events = current.events[seen:]
+            if not events and not current.done:
+                # Comment line as a heartbeat so proxies do not close the connection.
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                yield f"event: {event['event']}\ndata: {json.dumps(event['message'])}\n\n"
+            seen += len(events)
+            if current.done:
+                return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# Shows the result of a finished job: the playlist preview, or the error page of the step that failed.
+@bp.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = sessionJob(job_id)
+    if not job.done:
+        return redirect(url_for('routes.job_progress', job_id=job_id))
+    if job.status == "failed":
+        return render_template(job.template)
+    if not jobManager.claim(job):
+        return redirect(url_for('routes.create_playlist'))
+
+    session.pop('job_id', None)
+    session['playlist_description'] = job.description
+    session['playlist_id'] = job.playlistID
+    response = Response(render_template('playlist_preview.html', playlistID=job.playlistID, description=job.description))
+    if job.serverTiming:
+        response.headers['X-Job-Server-Timing'] = job.serverTiming
+    return response
+
+# Cancels a job, called by the progress page when the user navigates away. Deletes the job's temporary playlist.
+@bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    sessionJob(job_id)
+    jobManager.cancel(job_id)
+    return '', 204
+
 # This is called when user clicks save to library, followed by back.
 # Returns back to playlist preview page, feeding playlist ID for proper displaying.
 @bp.route('/return_to_preview/<playlist_id>')
@@ -144,7 +274,7 @@ def save_playlist():
     if not playlist_name:
         playlist_name = generatePlaylistName(description)
     
-    access_token = session.get('access_token')
+    access_token = credentials.currentAccessToken()
     if not access_token:
         return redirect(url_for('routes.login'))
     
@@ -165,7 +295,7 @@ def save_playlist():
 @bp.route('/discard_playlist')
 def discard_playlist():
     playlist_id = request.args.get('id')
-    access_token = session.get('access_token')
+    access_token = credentials.currentAccessToken()
     
     if access_token and playlist_id:
         deletePlaylist(access_token, playlist_id)
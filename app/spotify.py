@@ -3,31 +3,41 @@
 # Contains numerous debug prints that are not visible in the user interface.
 # These functions are called in routes.py.
 
-import requests
+import time
+
 from flask import current_app
 
-# Searches for existing playlists based on keyphrases extracted from user-inputted description.
-def searchForPlaylists(accessToken, keyphrases):
-    searchURL = "https://api.spotify.com/v1/search"
-    headers = {"Authorization": f"Bearer {accessToken}"}
-    playlists = []
-    # For each extracted keyphrase from the user description, this code requests 5 playlists from Spotify Web API that match the keyphrase.
-    for k in keyphrases:
-        # Search parameters for retrieving 5 playlists from spotify for each keyphrase
-        parameters = {"q": k, "type": "playlist", "limit": 5}
-        try:
-            response = requests.get(searchURL, headers=headers, params=parameters)
-        except Exception as e:
-            print("Failed to fetch playlists as an exception has occurred: {e}")
-            return None
-        if response.status_code == 200:
-            playlists.extend(response.json().get("playlists", {}).get("items", []))
-        else:
-            print("Error with Spotify API")
-            return None
-    return playlists
-
-# Takes list of tracks (from getPotentialTracks() function) and integer k (number of songs requested) and returns the top-k most frequent tracks.
+from .playlist_cache import TRACK_PAGE_SIZE, playlistCache
+from .playlist_corpus import playlistCorpus
+from .spotify_client import client
+from .tracing import recordStage, stage
+
+# Searches Spotify for playlists matching a single keyphrase. Returns the list of playlists, or None if the search failed.
+# With CORPUS_ENABLED, the local playlist corpus (playlist_corpus.py) answers the search instead if it has enough fresh matches
+# (without snapshot IDs, see loadPlaylistTracks()), and every playlist Spotify returns is added to it.
+# useCorpus=False always asks Spotify (used by the corpus warm-up job).
+def searchKeyphrase(accessToken, keyphrase, limit=5, useCorpus=True):
+    if useCorpus:
+        with stage("corpus"):
+            results = playlistCorpus.search(keyphrase, limit)
+        if results is not None:
+            return results
+    # Search parameters for retrieving 5 playlists from spotify for the keyphrase
+    parameters = {"q": keyphrase, "type": "playlist", "limit": limit}
+    try:
+        with stage("search"):
+            response = client.get("/v1/search", accessToken, params=parameters)
+    except Exception as e:
+        print(f"Failed to fetch playlists as an exception has occurred: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error with Spotify API while searching for '{keyphrase}': {response.status_code}")
+        return None
+    results = response.json().get("playlists", {}).get("items", [])
+    playlistCorpus.add(keyphrase, results)
+    return results
+
+# Takes a dictionary of track ID -> frequency and integer k (number of songs requested) and returns the top-k most frequent tracks.
 # Uses a manually implemented min-heap of size k to keep track of the k most frequent track IDs in increasing order
 # Returns heap contents as list sorted by descending values (track IDs with highest frequencies appear first)
 # A min-heap of size k is used (instead of a max-heap) to efficiently keep track of only the k most frequent tracks.
@@ -79,49 +89,104 @@ def topKMostFrequentTracks(tracks, k):
     result = sorted(heap, key=lambda x: -x[0])
     return [(track_id, freq) for freq, track_id in result]
 
-# Takes list of playlists (from searchForPlaylists() function) and other user-inputted settings and returns a list of potential tracks.
-# Creates dictionary with every track, counts the frequency of each track across all playlists, sorts them in descending order, and returns the tracks.
-# Essentially, the songs that appear most frequently in existing Spotify playlists that match the extracted keyphrases are pushed to the top of the generated playlist.
-def getPotentialTracks(accessToken, playlists, numSongs, excludeExplicit):
-    tracks = {}
-    size = min(numSongs, 100)
-    for p in playlists:
-        # This avoids invalid playlist entries/playlists with no IDs, as Spotify sometimes returns playlists with "null data" mixed with valid playlists.
-        if not isinstance(p, dict):
-            print(f"Skipping invalid playlist entry: {p}")
-            continue
-
-        playlistID = p.get("id")
-        if not playlistID:
-            print(f"Skipping playlist with no ID: {p}")
-            continue
-
-        tracksURL = f"https://api.spotify.com/v1/playlists/{playlistID}/tracks"
-        headers = {"Authorization": f"Bearer {accessToken}"}
+# Default number of playlist track requests that may be in flight at the same time.
+# Can be overridden with SPOTIFY_MAX_CONCURRENT_FETCHES in config.py.
+DEFAULT_MAX_CONCURRENT_FETCHES = 8
+
+# Default number of 100-track pages fetched per playlist. Can be overridden with SPOTIFY_MAX_TRACK_PAGES in config.py.
+# Setting it to 1 only counts the first 100 tracks of each playlist.
+DEFAULT_MAX_TRACK_PAGES = 5
+
+# Only the fields we actually read are requested from Spotify. Full track objects (albums, artists, images, available markets)
+# are roughly 10x larger than this, and all of that would otherwise be downloaded and parsed just to read an ID and a flag.
+TRACK_FIELDS = "next,items(track(id,explicit))"
+
+# Fetches the tracks of a single playlist, following pagination up to maxPages pages, and times the requests.
+# Returns a tuple of (entries, status code, elapsed milliseconds, complete, pages) where entries is a list of (trackID, explicit) tuples in playlist order,
+# complete says whether the whole playlist was read (as opposed to stopping at maxPages or at a failed page) and pages is the number
+# of pages actually read.
+# Each page is reduced to these tuples as soon as it arrives, so only one small page of parsed JSON is alive at a time.
+# entries is None if a request raised an exception. If a later page fails, the tracks from the earlier pages are kept.
+# This runs inside worker threads, so it must not touch current_app or the session.
+def fetchPlaylistTracks(accessToken, playlistID, maxPages=DEFAULT_MAX_TRACK_PAGES):
+    start = time.perf_counter()
+    entries = []
+    statusCode = None
+    complete = False
+    pages = 0
+    for page in range(maxPages):
+        parameters = {"fields": TRACK_FIELDS, "limit": TRACK_PAGE_SIZE, "offset": page * TRACK_PAGE_SIZE}
         try:
-            response = requests.get(tracksURL, headers=headers)
+            response = client.get(f"/v1/playlists/{playlistID}/tracks", accessToken, params=parameters)
         except Exception as e:
-            print("Failed to fetch tracks as an exception has occurred: {e}")
-            return None
-        # Response status code 200 means the request to Spotify's API was successfully completed.
-        # Upon a successful request, tracks are added to the tracks dictionary and their frequency is counted.
-        if response.status_code == 200:
-            for item in response.json().get("items", []):
-                track = item.get("track")
-                if track:
-                    if excludeExplicit and track.get("explicit", False):
-                        continue
-                    trackID = track.get("id")
-                    if trackID:
-                        tracks[trackID] = tracks.get(trackID, 0) + 1
-        else:
-            print(f"Error fetching tracks for playlist {playlistID}: {response.status_code}")
-    
-    return topKMostFrequentTracks(tracks, numSongs)
+            print(f"Failed to fetch tracks as an exception has occurred: {e}")
+            if page == 0:
+                entries = None
+            break
+        if response.status_code != 200:
+            if page == 0:
+                statusCode = response.status_code
+            else:
+                print(f"Error fetching page {page} of playlist {playlistID}: {response.status_code}")
+            break
+        statusCode = 200
+        pages += 1
+        data = response.json()
+        for item in data.get("items") or []:
+            track = item.get("track") if item else None
+            if track:
+                entries.append((track.get("id"), track.get("explicit", False)))
+        if not data.get("next"):
+            complete = True
+            break
+    elapsed = (time.perf_counter() - start) * 1000
+    recordStage("fetch", elapsed / 1000)
+    return entries, statusCode, elapsed, complete, pages
+
+# Returns the tracks of a playlist from the playlist cache if its snapshot is cached, otherwise fetches them and stores them in the cache.
+# A playlist found without a snapshot ID (served from the playlist corpus) is served from any cache entry fetched within CORPUS_TTL,
+# the same freshness bound the corpus applies to the playlist itself.
+# Returns (entries, status code, elapsed milliseconds, complete, cached) where cached says whether it was served from the cache.
+# Only the pages that were actually read are recorded in the cache, so a playlist cut short by a failed page is fetched again
+# next time instead of being served truncated.
+# Safe to call from worker threads (each thread uses its own cache connection).
+def loadPlaylistTracks(accessToken, playlistID, snapshotID, maxPages):
+    cached = playlistCache.get(playlistID, snapshotID, maxPages, maxAge=None if snapshotID else playlistCorpus.ttl)
+    if cached is not None:
+        return cached, 200, 0.0, True, True
+    entries, statusCode, elapsed, complete, pages = fetchPlaylistTracks(accessToken, playlistID, maxPages)
+    if statusCode == 200:
+        playlistCache.put(playlistID, snapshotID, entries, pages, complete)
+    return entries, statusCode, elapsed, complete, False
 
-# Returns access token for Spotify Web API, this is written as a function due to the fact that the access token is not constant and is unique to each session.
+# Most track IDs Spotify accepts in one /v1/tracks request.
+TRACK_BATCH_SIZE = 50
+
+# Fetches full track objects for up to 50 track IDs in one request. Returns the list of track objects in the order of trackIDs
+# (None for IDs Spotify does not know), or None if the request failed. Safe to call from worker threads.
+def fetchTracks(accessToken, trackIDs):
+    try:
+        response = client.get("/v1/tracks", accessToken, params={"ids": ",".join(trackIDs)})
+    except Exception as e:
+        print(f"Failed to fetch track metadata as an exception has occurred: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching metadata for {len(trackIDs)} tracks: {response.status_code}")
+        return None
+    return response.json().get("tracks") or []
+
+# Resolves the fetch settings, falling back to config.py and then to the defaults above. Must be called with an app context.
+def getFetchSettings(maxConcurrent=None, maxPages=None):
+    if maxConcurrent is None:
+        maxConcurrent = current_app.config.get('SPOTIFY_MAX_CONCURRENT_FETCHES', DEFAULT_MAX_CONCURRENT_FETCHES)
+    if maxPages is None:
+        maxPages = current_app.config.get('SPOTIFY_MAX_TRACK_PAGES', DEFAULT_MAX_TRACK_PAGES)
+    return maxConcurrent, maxPages
+
+# Returns the token response for the authorization code of a login (access_token, refresh_token, expires_in), this is written as a
+# function due to the fact that the access token is not constant and is unique to each session. Returns None if Spotify refused the code
+# or could not be reached.
 def getTokenFromCode(code):
-    tokenUrl = "https://accounts.spotify.com/api/token"
     apiData = {
         "grant_type": "authorization_code",
         "code": code,
@@ -129,14 +194,60 @@ def getTokenFromCode(code):
         "client_id": current_app.config['CLIENT_ID'],
         "client_secret": current_app.config['CLIENT_SECRET'],
     }
-    response = requests.post(tokenUrl, data=apiData)
+    try:
+        response = client.post(f"{client.accountsBase}/api/token", data=apiData)
+    except Exception as e:
+        print(f"Failed to exchange authorization code: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error exchanging authorization code: {response.status_code}, {response.text}")
+        return None
+    return response.json()
+
+# Returns a new token response for a refresh token, or None if Spotify refused it (e.g. the user revoked access).
+# Spotify may or may not include a new refresh_token, see credentials.py.
+def refreshAccessToken(refreshToken):
+    apiData = {
+        "grant_type": "refresh_token",
+        "refresh_token": refreshToken,
+        "client_id": current_app.config['CLIENT_ID'],
+        "client_secret": current_app.config['CLIENT_SECRET'],
+    }
+    try:
+        response = client.post(f"{client.accountsBase}/api/token", data=apiData)
+    except Exception as e:
+        print(f"Failed to refresh access token: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error refreshing access token: {response.status_code}, {response.text}")
+        return None
+    return response.json()
+
+# Returns an app access token from the client credentials flow, or None if Spotify refused it or could not be reached.
+# It can search and read public playlists but cannot act on behalf of a user. Used by the batch generator (batch.py).
+def getClientToken():
+    apiData = {
+        "grant_type": "client_credentials",
+        "client_id": current_app.config['CLIENT_ID'],
+        "client_secret": current_app.config['CLIENT_SECRET'],
+    }
+    try:
+        response = client.post(f"{client.accountsBase}/api/token", data=apiData)
+    except Exception as e:
+        print(f"Failed to fetch client credentials token: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching client credentials token: {response.status_code}, {response.text}")
+        return None
     return response.json().get('access_token')
 
-# Returns Spotify user ID from access token.
+# Returns Spotify user ID from access token, or None if it could not be fetched.
 def getUserID(accessToken):
-    url = "https://api.spotify.com/v1/me"
-    headers = {"Authorization": f"Bearer {accessToken}"}
-    response = requests.get(url, headers=headers)
+    try:
+        response = client.get("/v1/me", accessToken)
+    except Exception as e:
+        print(f"Failed to fetch user ID: {e}")
+        return None
     if response.status_code != 200:
         print(f"Error fetching user ID: {response.status_code}, {response.text}")
         return None
@@ -145,16 +256,18 @@ def getUserID(accessToken):
     return userID
 
 # Creates temporary playlist for display of the generated playlist in the user's account, returns the playlistID.
-# This playlist is discarded if the user does not like it. (deletePlaylist())
+# This playlist is discarded if the user does not like it. (deletePlaylist()) Returns None if it could not be created.
 def createTempPlaylist(accessToken, userID):
-    url = f"https://api.spotify.com/v1/users/{userID}/playlists"
-    headers = {"Authorization": f"Bearer {accessToken}"}
     data = {
         "name": "Generated Playlist",
         "description": "A temporary playlist for previewing. Generated by Jamify",
         "public": False
     }
-    response = requests.post(url, headers=headers, json=data)
+    try:
+        response = client.post(f"/v1/users/{userID}/playlists", accessToken, json=data)
+    except Exception as e:
+        print(f"Failed to create playlist: {e}")
+        return None
     if response.status_code == 403:
         # When the response status code is 403, this means that Spotify Web API has not authorized the Spotify user to use this app.
         # This is because the app is in development mode, the api mode that allows all users is extended quota mode.
@@ -167,33 +280,87 @@ def createTempPlaylist(accessToken, userID):
     print(f"Created Playlist ID: {playlistID}")
     return playlistID
 
-# Takes a playlistID and a list of trackURIs and adds the tracks to the playlist.
+# Spotify accepts at most 100 tracks per request that adds or replaces playlist tracks.
+PLAYLIST_WRITE_CHUNK = 100
+
+# Statuses for which a failed write may still have been applied by Spotify, see writePlaylistTracks().
+UNCERTAIN_WRITE_STATUSES = {500, 502, 503, 504}
+
+# Returns the number of tracks in a playlist, or None if it could not be read.
+def getPlaylistLength(accessToken, playlistID):
+    try:
+        response = client.get(f"/v1/playlists/{playlistID}", accessToken, params={"fields": "tracks.total"})
+    except Exception as e:
+        print(f"Failed to read playlist {playlistID}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error reading playlist {playlistID}: {response.status_code}, {response.text}")
+        return None
+    return response.json().get("tracks", {}).get("total")
+
+# Writes trackURIs to a playlist in order, in chunks of 100 (the most Spotify accepts per request). With replace=True the playlist's
+# current contents are replaced (the first chunk is a PUT), which lets a regeneration reuse its temporary playlist.
+# Spotify applies each write to the playlist as it is at that moment, so the chunks are sent one after another on the client's pooled
+# keep-alive connection rather than concurrently, which keeps them in order. A chunk that fails is retried on its own up to `retries`
+# times. A POST that failed with a 5xx may still have been applied, so the playlist's length is checked before sending it again.
+# Returns True if every track was written.
+def writePlaylistTracks(accessToken, playlistID, trackURIs, replace=False, retries=2):
+    chunks = [trackURIs[i:i + PLAYLIST_WRITE_CHUNK] for i in range(0, len(trackURIs), PLAYLIST_WRITE_CHUNK)]
+    if replace and not chunks:
+        chunks = [[]]
+    written = 0
+    for index, chunk in enumerate(chunks):
+        appending = not (replace and index == 0)
+        method = client.post if appending else client.put
+        for attempt in range(retries + 1):
+            try:
+                response = method(f"/v1/playlists/{playlistID}/tracks", accessToken, json={"uris": chunk})
+                status = response.status_code
+            except Exception as e:
+                print(f"Failed to write tracks {written}-{written + len(chunk)} to playlist {playlistID}: {e}")
+                response, status = None, None
+            if status in (200, 201):
+                break
+            if response is not None:
+                print(f"Error writing tracks {written}-{written + len(chunk)} to playlist {playlistID}: {status}, {response.text}")
+            if appending and (status is None or status in UNCERTAIN_WRITE_STATUSES):
+                length = getPlaylistLength(accessToken, playlistID)
+                if length == written + len(chunk):
+                    # The chunk was added even though the response was lost or failed.
+                    break
+                if length != written:
+                    # Unknown state (or the length could not be read), retrying could duplicate or misorder tracks.
+                    print(f"Not retrying the write to playlist {playlistID}, expected {written} tracks but found {length}")
+                    return False
+            if attempt == retries:
+                return False
+        written += len(chunk)
+    print(f"Wrote {written} tracks to playlist {playlistID} in {len(chunks)} requests")
+    return True
+
+# Takes a playlistID and a list of trackURIs and adds the tracks to the playlist. Returns True if every track was added.
 def addTracksToPlaylist(accessToken, playlistID, trackURIs):
-    url = f"https://api.spotify.com/v1/playlists/{playlistID}/tracks"
-    headers = {"Authorization": f"Bearer {accessToken}"}
-    data = {"uris": trackURIs}
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code != 201:
-        print(f"Error adding tracks to playlist: {response.status_code}, {response.text}")
-    else:
-        print(f"Tracks added successfully to playlist {playlistID}")
+    return writePlaylistTracks(accessToken, playlistID, trackURIs)
+
+# Replaces the tracks of a playlist with trackURIs. Returns True if every track was written.
+def replacePlaylistTracks(accessToken, playlistID, trackURIs):
+    return writePlaylistTracks(accessToken, playlistID, trackURIs, replace=True)
 
 # This function is called when the user approves of the generated playlist and wants to save it to their library.
 # Since the playlist is already in their library, the playlist name and description is updated to the user's liking.
 # Returns true upon successful playlist update, False otherwise.
 def updatePlaylist(accessToken, playlistID, name, description):
     print(f"Updating playlist - Name: {name}, Description: {description}")  # Debug print
-    url = f"https://api.spotify.com/v1/playlists/{playlistID}"
-    headers = {
-        "Authorization": f"Bearer {accessToken}",
-        "Content-Type": "application/json"
-    }
     data = {
         "name": name,
         "description": description
     }
     print(f"Update playlist request data: {data}")  # Debug print
-    response = requests.put(url, headers=headers, json=data)
+    try:
+        response = client.put(f"/v1/playlists/{playlistID}", accessToken, json=data)
+    except Exception as e:
+        print(f"Failed to update playlist: {e}")
+        return False
     # Response status code 200 indicates successful update, any other status code indicates an error.
     if response.status_code != 200:
         print(f"Error updating playlist: {response.status_code}, {response.text}")
@@ -203,9 +370,11 @@ def updatePlaylist(accessToken, playlistID, name, description):
 # Deletes playlist from user's library given a playlist ID (generated playlist).
 # Returns True upon successful deletion, False if otherwise.
 def deletePlaylist(accessToken, playlistID):
-    url = f"https://api.spotify.com/v1/playlists/{playlistID}/followers"
-    headers = {"Authorization": f"Bearer {accessToken}"}
-    response = requests.delete(url, headers=headers)
+    try:
+        response = client.delete(f"/v1/playlists/{playlistID}/followers", accessToken)
+    except Exception as e:
+        print(f"Failed to delete playlist: {e}")
+        return False
     # Response status code 200 indicates successful deletion, any other status code indicates an error.
     if response.status_code != 200:
         print(f"Error deleting playlist: {response.status_code}, {response.text}")
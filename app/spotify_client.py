@@ -0,0 +1,198 @@
+# Author: Adrian Simon
+# Shared HTTP client for the Spotify Web API. Every request made in spotify.py goes through the single client object defined here.
+# The client owns one pooled requests session (keep-alive connections instead of a new TLS handshake per call), applies a per-token
+# token-bucket rate limiter, retries failed requests with jittered exponential backoff that honors Spotify's Retry-After header,
+# and applies a timeout to every request.
+
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError
+
+from .tracing import endpointLabel, recordOutbound
+
+# Status codes that are worth retrying. 429 means we are being rate limited, 5xx are transient Spotify errors.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Methods that are safe to retry after a 5xx. A POST that failed with a 5xx may still have been applied (e.g. tracks added),
+# so POSTs are only retried on 429, which Spotify guarantees was not processed.
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+# Returns True if a request failed before it reached Spotify (the connection could not be opened), so even a POST is safe to send
+# again. A read timeout or a connection dropped mid-response may come after Spotify applied the request.
+def failedBeforeSending(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+# Limits the number of rate limiters kept in memory, one is kept per access token.
+MAX_TRACKED_TOKENS = 1024
+
+# Token bucket rate limiter. Allows bursts of up to capacity requests and refills at rate requests per second.
+# acquire() blocks until a token is available. pause() blocks the bucket entirely, which is used when Spotify responds with 429.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blockedUntil = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blockedUntil:
+                    wait = self.blockedUntil - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+
+class SpotifyClient:
+    def __init__(self, apiBase="https://api.spotify.com", accountsBase="https://accounts.spotify.com",
+                 rate=25.0, burst=60, maxRetries=3, backoffBase=0.5, backoffMax=8.0, maxRetryAfter=10.0,
+                 timeout=(3.05, 10), poolSize=32):
+        self.apiBase = apiBase
+        self.accountsBase = accountsBase
+        self.rate = rate
+        self.burst = burst
+        self.maxRetries = maxRetries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.maxRetryAfter = maxRetryAfter
+        self.timeout = timeout
+        self.buckets = OrderedDict()
+        self.bucketsLock = threading.Lock()
+        self.session = requests.Session()
+        self.mountAdapter(poolSize)
+
+    # Reads optional overrides from config.py. Called once from create_app().
+    def init_app(self, app):
+        config = app.config
+        self.apiBase = config.get('SPOTIFY_API_BASE', self.apiBase)
+        self.accountsBase = config.get('SPOTIFY_ACCOUNTS_BASE', self.accountsBase)
+        self.rate = config.get('SPOTIFY_RATE_LIMIT', self.rate)
+        self.burst = config.get('SPOTIFY_RATE_BURST', self.burst)
+        self.maxRetries = config.get('SPOTIFY_MAX_RETRIES', self.maxRetries)
+        self.backoffBase = config.get('SPOTIFY_BACKOFF_BASE', self.backoffBase)
+        self.backoffMax = config.get('SPOTIFY_BACKOFF_MAX', self.backoffMax)
+        self.maxRetryAfter = config.get('SPOTIFY_MAX_RETRY_AFTER', self.maxRetryAfter)
+        self.timeout = config.get('SPOTIFY_TIMEOUT', self.timeout)
+        if 'SPOTIFY_POOL_SIZE' in config:
+            self.mountAdapter(config['SPOTIFY_POOL_SIZE'])
+
+    # The pool size should be at least the number of concurrent requests, otherwise connections are discarded instead of reused.
+    def mountAdapter(self, poolSize):
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # Returns the rate limiter for an access token, creating it if needed. Least recently used limiters are dropped.
+    def bucketFor(self, accessToken):
+        with self.bucketsLock:
+            bucket = self.buckets.get(accessToken)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[accessToken] = bucket
+                if len(self.buckets) > MAX_TRACKED_TOKENS:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(accessToken)
+            return bucket
+
+    # Full jitter exponential backoff: a random delay between 0 and base * 2^attempt, capped at backoffMax.
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoffMax, self.backoffBase * (2 ** attempt)))
+
+    # Returns the number of seconds Spotify asked us to wait, or None if there is no usable Retry-After header.
+    def retryAfter(self, response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+
+    # Sends a request and returns the final response. Paths starting with "/" are relative to the Spotify Web API.
+    # Retryable responses are retried up to maxRetries times. If retries run out (or Spotify asks us to wait longer than
+    # maxRetryAfter) the last response is returned so callers can handle the status code as before.
+    # Network errors are retried the same way and re-raised once retries run out. For POSTs only failures to connect are retried,
+    # any other network error is re-raised right away since the request may already have been applied.
+    def request(self, method, url, accessToken=None, **kwargs):
+        method = method.upper()
+        if url.startswith("/"):
+            url = self.apiBase + url
+        headers = dict(kwargs.pop("headers", None) or {})
+        if accessToken:
+            headers["Authorization"] = f"Bearer {accessToken}"
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self.bucketFor(accessToken) if accessToken else None
+        endpoint = endpointLabel(method, url)
+
+        for attempt in range(self.maxRetries + 1):
+            if bucket:
+                bucket.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except requests.RequestException as e:
+                recordOutbound("spotify", endpoint, "error", 0, time.perf_counter() - start)
+                if attempt == self.maxRetries or (method not in IDEMPOTENT_METHODS and not failedBeforeSending(e)):
+                    raise
+                delay = self.backoff(attempt)
+                print(f"Spotify request {method} {url} failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            recordOutbound("spotify", endpoint, response.status_code, len(response.content), time.perf_counter() - start)
+
+            retryable = response.status_code == 429 or (response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS)
+            if not retryable or attempt == self.maxRetries:
+                return response
+
+            delay = self.retryAfter(response)
+            if delay is None:
+                delay = self.backoff(attempt)
+            elif delay > self.maxRetryAfter:
+                print(f"Spotify asked to retry {method} {url} after {delay:.0f}s, giving up")
+                return response
+            if response.status_code == 429 and bucket:
+                # Hold back every request made with this token, not just this one.
+                bucket.pause(delay)
+            print(f"Spotify request {method} {url} returned {response.status_code}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+        return response
+
+    def get(self, url, accessToken=None, **kwargs):
+        return self.request("GET", url, accessToken, **kwargs)
+
+    def post(self, url, accessToken=None, **kwargs):
+        return self.request("POST", url, accessToken, **kwargs)
+
+    def put(self, url, accessToken=None, **kwargs):
+        return self.request("PUT", url, accessToken, **kwargs)
+
+    def delete(self, url, accessToken=None, **kwargs):
+        return self.request("DELETE", url, accessToken, **kwargs)
+
+# Single client shared by every function in spotify.py (and therefore every gunicorn worker thread).
+client = SpotifyClient()
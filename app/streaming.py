@@ -0,0 +1,237 @@
+# Author: Adrian Simon
+# Finds the candidate tracks for a generation: searches Spotify for playlists matching every keyphrase, fetches their tracks and
+# counts how often each track appears. Instead of waiting for every keyphrase search before fetching any playlist, and for every
+# fetch before counting, the three stages are chained through one thread pool:
+#   search for keyphrase N finishes -> its playlists are queued for fetching right away
+#   a playlist's tracks arrive       -> they are counted by the aggregator (aggregation.py)
+# so total latency approaches the slowest single search -> fetch chain instead of the sum of all stages.
+# A playlist returned by several keyphrases is only fetched and counted once, at its best position over all of those searches
+# (lowest keyphrase index, then lowest search result index). That position is only known once every search has returned, so
+# playlists fetched before then are held and counted when the last search comes back. Counting is cheap next to fetching, and
+# this way tie-breaks and position weights never depend on which search happened to finish first.
+# Fetches are started in order of expected relevance (every keyphrase's first search result, then every keyphrase's second, ...)
+# with at most maxConcurrent in flight.
+#
+# Adaptive fetch mode (ADAPTIVE_FETCH = True in config.py): once every search has returned, the remaining fetches can only raise a
+# track's score by the summed weight of the playlists still to be counted (each playlist counts a track at most once in this mode).
+# As soon as the track in (K+1)-th place plus that bound can no longer reach the K-th place, the top-K set is settled, so the
+# remaining fetches are skipped and in-flight ones are abandoned. ADAPTIVE_FETCH_TOLERANCE allows stopping earlier, when an outside
+# track could still finish ahead of the K-th place but by less than the tolerance. Scores of the returned tracks are then the
+# scores counted so far. Together with SPOTIFY_SEARCH_LIMIT this allows searching for more playlists per keyphrase while only
+# fetching the ones that can change the result.
+
+import heapq
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+
+from .aggregation import createAggregator
+from .executor import CANCEL_POLL_INTERVAL
+from .spotify import getFetchSettings, loadPlaylistTracks, searchKeyphrase
+from .tracing import adaptiveSkipped, stage, submitWithContext
+from .track_metadata import trackMetadata
+
+# Number of playlists requested per keyphrase when SPOTIFY_SEARCH_LIMIT is not set in config.py.
+DEFAULT_SEARCH_LIMIT = 5
+
+# Search threads reserved when keyphrases arrive from a stream and their number is not known up front.
+STREAMED_SEARCH_WORKERS = 8
+
+# Resolves the adaptive fetch settings, falling back to config.py. Must be called with an app context.
+def getAdaptiveSettings(adaptive=None, tolerance=None):
+    if adaptive is None:
+        adaptive = current_app.config.get('ADAPTIVE_FETCH', False)
+    if tolerance is None:
+        tolerance = current_app.config.get('ADAPTIVE_FETCH_TOLERANCE', 0)
+    return adaptive, tolerance
+
+# Returns True once every track outside the current top k is bound to finish less than `tolerance` above the k-th place, given
+# that the playlists still to be counted can add at most `remaining` to any score. With tolerance 0 an outside track must finish
+# strictly below the k-th place, since a tie might go its way.
+def topKSettled(counter, k, remaining, tolerance):
+    if k <= 0:
+        return True
+    ranked = counter.topK(k + 1)
+    if len(ranked) < k:
+        return False
+    kthScore = ranked[k - 1][1]
+    nextScore = ranked[k][1] if len(ranked) > k else 0
+    return nextScore + remaining - kthScore < tolerance
+
+# Searches for playlists matching every keyphrase and returns the numSongs most frequent tracks across them as (trackID, frequency) tuples.
+# keyphrases is a list, or an iterator that produces keyphrases over time (e.g. streamKeyphrasesAndName() in gpt_integration.py),
+# in which case each keyphrase's search starts as soon as the iterator yields it.
+# Returns None if every search failed or a playlist fetch raised an exception. A search that fails is otherwise skipped.
+# cancelled is an optional threading.Event. Once it is set, queued requests are dropped and None is returned.
+# adaptive and tolerance override ADAPTIVE_FETCH and ADAPTIVE_FETCH_TOLERANCE, see the top of this file.
+# pool is an optional CandidatePool (candidate_pool.py). Playlists already in the pool are not fetched again, the scores counted
+# by this run are merged into it, and the result is ranked from the whole pool. A pool needs every playlist counted, with explicit
+# tracks included so it can be re-ranked with either setting, so adaptive fetching is turned off for it. Pools are only created with
+# ADAPTIVE_FETCH on when CANDIDATE_POOL_ENABLED says so explicitly (candidate_pool.py).
+# With TRACK_HYDRATION on, versions of the same song are merged before the top numSongs are cut (see track_metadata.py).
+# shared is an optional object with search() and load() methods replacing searchKeyphrase() and loadPlaylistTracks(), used by the
+# batch generator (batch.py) to share searches and fetches between jobs.
+def streamPotentialTracks(accessToken, keyphrases, numSongs, excludeExplicit, maxConcurrent=None, maxPages=None, cancelled=None,
+                          adaptive=None, tolerance=None, pool=None, shared=None):
+    maxConcurrent, maxPages = getFetchSettings(maxConcurrent, maxPages)
+    adaptive, tolerance = getAdaptiveSettings(adaptive, tolerance)
+    if pool is not None:
+        adaptive = False
+    searchLimit = current_app.config.get('SPOTIFY_SEARCH_LIMIT', DEFAULT_SEARCH_LIMIT)
+    search = shared.search if shared is not None else searchKeyphrase
+    load = shared.load if shared is not None else loadPlaylistTracks
+    maxConcurrent = max(1, maxConcurrent)
+    counter = createAggregator()
+    seen = set(pool.playlistIDs) if pool is not None else set()
+    # New keyphrases are ranked after the ones already in the pool.
+    firstKeyphrase = len(pool.keyphrases) if pool is not None else 0
+    # Keyphrases in the order their searches were started.
+    searched = []
+    streamed = not isinstance(keyphrases, (list, tuple))
+    # Whether the keyphrase iterator may still produce more keyphrases.
+    keyphrasesOpen = streamed
+    # Playlists counted for the pool: (playlistID, entries, order, followers).
+    counted = []
+    explicitIDs = set()
+    failures = 0
+    fetched = 0
+    cachedCount = 0
+    searchesLeft = 0
+    # Playlists waiting to be fetched, most relevant first: (search result index, keyphrase index, playlistID, snapshotID, followers).
+    queued = []
+    # Best (keyphrase index, search result index) of every playlist found so far, used as its order when counting.
+    orders = {}
+    # Playlists fetched before every search returned: (playlistID, entries, followers).
+    held = []
+    fetching = 0
+    start = time.perf_counter()
+
+    # Searches get their own threads so they never wait behind playlist fetches.
+    executor = ThreadPoolExecutor(max_workers=maxConcurrent + (STREAMED_SEARCH_WORKERS + 1 if streamed else len(keyphrases)))
+    try:
+        pending = {}
+
+        def countPlaylist(playlistID, entries, followers):
+            if pool is not None:
+                counter.addPlaylist(entries, orders[playlistID], False, followers)
+                counted.append((playlistID, entries, orders[playlistID], followers))
+                explicitIDs.update(trackID for trackID, explicit in entries if explicit)
+            else:
+                counter.addPlaylist(entries, orders[playlistID], excludeExplicit, followers, unique=adaptive)
+
+        # The pool's scores without the given playlists, for when a concurrent run merged them into the pool first.
+        def recount(skipped):
+            recounted = createAggregator()
+            for playlistID, entries, order, followers in counted:
+                if playlistID not in skipped:
+                    recounted.addPlaylist(entries, order, False, followers)
+            return recounted.export()
+
+        def startSearch(keyphrase):
+            future = submitWithContext(executor, search, accessToken, keyphrase, searchLimit)
+            pending[future] = ("search", firstKeyphrase + len(searched), keyphrase, None)
+            searched.append(keyphrase)
+
+        if streamed:
+            # Keyphrases are pulled from the iterator one at a time on a worker thread, next(iterator, None) returns None at the end.
+            keyphrases = iter(keyphrases)
+            pending[submitWithContext(executor, next, keyphrases, None)] = ("keyphrase", None, None, None)
+        else:
+            for keyphrase in keyphrases:
+                startSearch(keyphrase)
+        searchesLeft = len(searched)
+
+        while pending:
+            done, _ = wait(pending, timeout=CANCEL_POLL_INTERVAL if cancelled is not None else None, return_when=FIRST_COMPLETED)
+            if cancelled is not None and cancelled.is_set():
+                return None
+            for future in done:
+                kind, order, name, followers = pending.pop(future)
+                if kind == "keyphrase":
+                    keyphrase = future.result()
+                    if keyphrase is None:
+                        keyphrasesOpen = False
+                    else:
+                        startSearch(keyphrase)
+                        searchesLeft += 1
+                        pending[submitWithContext(executor, next, keyphrases, None)] = ("keyphrase", None, None, None)
+                elif kind == "search":
+                    searchesLeft -= 1
+                    results = future.result()
+                    if results is None:
+                        failures += 1
+                        continue
+                    print(f"Search for '{name}' returned {len(results)} playlists after {(time.perf_counter() - start) * 1000:.1f} ms")
+                    for j, p in enumerate(results):
+                        # Spotify sometimes returns playlists with "null data" mixed with valid playlists.
+                        if not isinstance(p, dict) or not p.get("id"):
+                            print(f"Skipping invalid playlist entry: {p}")
+                            continue
+                        playlistID = p["id"]
+                        if playlistID in orders:
+                            orders[playlistID] = min(orders[playlistID], (order, j))
+                        if playlistID in seen:
+                            continue
+                        seen.add(playlistID)
+                        orders[playlistID] = (order, j)
+                        # Follower counts are only used for weighting when Spotify includes them in the playlist object.
+                        followers = (p.get("followers") or {}).get("total")
+                        heapq.heappush(queued, (j, order, playlistID, p.get("snapshot_id"), followers))
+                else:
+                    fetching -= 1
+                    entries, statusCode, elapsed, complete, cached = future.result()
+                    if entries is None:
+                        return None
+                    if cached:
+                        cachedCount += 1
+                        print(f"Loaded tracks for playlist {name} from cache")
+                    else:
+                        fetched += 1
+                        print(f"Fetched tracks for playlist {name} in {elapsed:.1f} ms")
+                    if statusCode != 200:
+                        print(f"Error fetching tracks for playlist {name}: {statusCode}")
+                    elif searchesLeft or keyphrasesOpen:
+                        held.append((name, entries, followers))
+                    else:
+                        countPlaylist(name, entries, followers)
+
+            if held and searchesLeft == 0 and not keyphrasesOpen:
+                for playlistID, entries, followers in held:
+                    countPlaylist(playlistID, entries, followers)
+                held.clear()
+
+            # The bound is only known once every search has returned, before that more playlists may still be found.
+            if adaptive and searchesLeft == 0 and not keyphrasesOpen and (queued or fetching):
+                remaining = sum(counter.maxPlaylistWeight(orders[playlistID], followers) for _, _, playlistID, _, followers in queued)
+                remaining += sum(counter.maxPlaylistWeight(orders[playlistID], followers)
+                                 for kind, _, playlistID, followers in pending.values() if kind == "fetch")
+                if topKSettled(counter, numSongs, remaining, tolerance):
+                    skipped = len(queued) + fetching
+                    print(f"Top {numSongs} settled, skipped {len(queued)} playlist fetches and abandoned {fetching} in flight")
+                    adaptiveSkipped.inc((), skipped)
+                    break
+
+            while queued and fetching < maxConcurrent:
+                j, keyphraseIndex, playlistID, snapshotID, followers = heapq.heappop(queued)
+                future = submitWithContext(executor, load, accessToken, playlistID, snapshotID, maxPages)
+                pending[future] = ("fetch", None, playlistID, followers)
+                fetching += 1
+    finally:
+        # Abandoned fetches finish in the background (and still fill the playlist cache), nobody waits for them.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if searched and failures == len(searched):
+        return None
+    print(f"Streamed {len(searched)} searches and {fetched} playlist fetches in {(time.perf_counter() - start) * 1000:.1f} ms, "
+          f"{cachedCount} playlists served from cache")
+    with stage("rank"):
+        if pool is not None:
+            pool.merge(searched, [playlistID for playlistID, _, _, _ in counted], counter.export(), explicitIDs, recount)
+            ranked = trackMetadata.rank(accessToken, lambda k: pool.rank(k, excludeExplicit), numSongs)
+        else:
+            ranked = trackMetadata.rank(accessToken, counter.topK, numSongs)
+    errorBound = counter.errorBound()
+    if errorBound:
+        print(f"Track frequencies are estimates, each may be overcounted by up to {errorBound}")
+    return ranked
@@ -0,0 +1,199 @@
+# Author: Adrian Simon
+# Lightweight per-request tracing and Prometheus-style metrics.
+# Code wraps each step of playlist generation in `with stage("name"):`, and the Spotify client / OpenAI calls report every outbound
+# request with recordOutbound(). Timings are collected in two places:
+#   the current request's Trace, which routes.py turns into a Server-Timing response header (visible in the browser's network tab)
+#   process-wide histograms and counters, which are served in the Prometheus text format by the /metrics route
+# The current trace lives in a context variable, so stages running on worker threads are attributed to the right request as long as
+# the work was submitted with submitWithContext() (or through the StageGraph in executor.py).
+# Metrics are per process, so with several gunicorn workers each worker reports its own numbers.
+# Tracing can be turned off with TRACING_ENABLED = False in config.py, in which case stage() and recordOutbound() do nothing.
+
+import contextvars
+import re
+import threading
+import time
+
+enabled = True
+currentTrace = contextvars.ContextVar("currentTrace", default=None)
+
+# Histogram bucket upper bounds in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Reads TRACING_ENABLED from config.py. Called once from create_app().
+def init_app(app):
+    global enabled
+    enabled = app.config.get('TRACING_ENABLED', True)
+
+# Submits fn to a concurrent.futures executor so that it runs in a copy of the caller's context (current trace and Flask app context).
+# Each submission needs its own copy because a context can only be entered by one thread at a time.
+def submitWithContext(executor, fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+class Histogram:
+    def __init__(self, name, help, labelNames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                base = formatLabels(self.labelNames, labels)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{{{base}{',' if base else ''}le=\"{bound}\"}} {cumulative}")
+                lines.append(f"{self.name}_bucket{{{base}{',' if base else ''}le=\"+Inf\"}} {series['count']}")
+                lines.append(f"{self.name}_sum{{{base}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{base}}} {series['count']}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labelNames):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{{{formatLabels(self.labelNames, labels)}}} {value}")
+        return lines
+
+def formatLabels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+stageDuration = Histogram("jamify_stage_duration_seconds", "Duration of playlist generation stages.", ("stage",))
+requestDuration = Histogram("jamify_request_duration_seconds", "Duration of requests handled by the app.", ("endpoint",))
+outboundRequests = Counter("jamify_outbound_requests_total", "Outbound requests made to Spotify and OpenAI.", ("service", "endpoint", "status"))
+outboundBytes = Counter("jamify_outbound_response_bytes_total", "Response bytes received from Spotify and OpenAI.", ("service", "endpoint"))
+outboundDuration = Histogram("jamify_outbound_duration_seconds", "Duration of outbound requests.", ("service", "endpoint"))
+adaptiveSkipped = Counter("jamify_adaptive_skipped_fetches_total", "Playlist fetches skipped by the adaptive fetch mode.", ())
+METRICS = (stageDuration, requestDuration, outboundRequests, outboundBytes, outboundDuration, adaptiveSkipped)
+
+# Timings collected for one request. Stages with the same name (e.g. one "fetch" per playlist) are summed and counted.
+# Shared by the worker threads of a request, hence the lock.
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.outboundCount = 0
+        self.outboundBytes = 0
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def addStage(self, name, seconds):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def addOutbound(self, status, size):
+        with self.lock:
+            self.outboundCount += 1
+            self.outboundBytes += size
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    # Formats the trace as a Server-Timing header value. Durations are in milliseconds as the spec requires.
+    # Repeated stages report their summed duration (which can exceed wall time when they ran concurrently) and their count.
+    def serverTiming(self):
+        with self.lock:
+            entries = []
+            for name, (total, count) in self.stages.items():
+                description = f';desc="{count} calls"' if count > 1 else ""
+                entries.append(f"{name}{description};dur={total * 1000:.1f}")
+            if self.outboundCount:
+                statuses = " ".join(f"{status}x{count}" for status, count in sorted(self.statuses.items(), key=str))
+                entries.append(f'upstream;desc="{self.outboundCount} calls, {self.outboundBytes} bytes, {statuses}"')
+            entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+# Times the body of a with block as a stage of the current request.
+class stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter() if enabled else None
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            recordStage(self.name, time.perf_counter() - self.start)
+        return False
+
+# Records a stage duration that was measured by the caller.
+def recordStage(name, seconds):
+    if not enabled:
+        return
+    stageDuration.observe((name,), seconds)
+    trace = currentTrace.get()
+    if trace is not None:
+        trace.addStage(name, seconds)
+
+# Groups a URL path into an endpoint label without IDs, e.g. "/v1/playlists/{id}/tracks", to keep label cardinality bounded.
+def endpointLabel(method, path):
+    path = re.sub(r"^https?://[^/]+", "", path).split("?", 1)[0]
+    path = re.sub(r"/(playlists|users|tracks|albums|artists)/[^/]+", r"/\1/{id}", path)
+    return f"{method} {path}"
+
+# Records one outbound request. status is the HTTP status code, or "error" if the request raised.
+def recordOutbound(service, endpoint, status, size, seconds):
+    if not enabled:
+        return
+    outboundRequests.inc((service, endpoint, str(status)))
+    if size:
+        outboundBytes.inc((service, endpoint), size)
+    outboundDuration.observe((service, endpoint), seconds)
+    trace = currentTrace.get()
+    if trace is not None:
+        trace.addOutbound(status, size)
+
+# Starts a trace for the current request. Returns a token for finishTrace().
+def startTrace():
+    if not enabled:
+        return None
+    return currentTrace.set(Trace())
+
+# Ends the current request's trace, records its duration, and adds the Server-Timing header to the response.
+def finishTrace(token, response, endpoint):
+    trace = currentTrace.get()
+    if token is None or trace is None:
+        return response
+    requestDuration.observe((endpoint,), time.perf_counter() - trace.start)
+    response.headers['Server-Timing'] = trace.serverTiming()
+    currentTrace.reset(token)
+    return response
+
+# Renders every metric in the Prometheus text exposition format.
+def renderMetrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
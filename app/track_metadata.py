@@ -0,0 +1,142 @@
+# Author: Adrian Simon
+# Track metadata hydration for the final ranking (TRACK_HYDRATION = True in config.py).
+# Counting only knows track IDs and the explicit flag, so the same song released several times (album and single, remaster,
+# compilation) is counted as different tracks and can appear in a playlist more than once. With hydration on, the best candidates
+# (numSongs plus some headroom) are looked up through the batched /v1/tracks endpoint, 50 IDs per request with the batches sent
+# concurrently, before the top-K cut:
+#   tracks sharing an ISRC, or the same first artist and normalized title, are merged into the best ranked version, which gets
+#   their summed score (the song is as popular as all its versions together)
+#   optional filters drop tracks outside TRACK_MIN_DURATION_MS / TRACK_MAX_DURATION_MS or below TRACK_MIN_POPULARITY
+# If too few candidates are left, the window is doubled and the next candidates are looked up.
+# Metadata is cached per track ID for a long time (track metadata rarely changes), so repeated generations mostly hit the cache.
+# A track whose metadata could not be fetched is kept as it is, so a failed lookup never makes a playlist worse than before.
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from .caching import MISSING, TTLCache
+from .spotify import TRACK_BATCH_SIZE, fetchTracks
+from .tracing import stage, submitWithContext
+
+# Bracketed or dashed title suffixes that name a release of the same recording rather than a different song,
+# e.g. "Song - Remastered 2011", "Song (Radio Edit)", "Song [Mono]".
+RELEASE_SUFFIX = re.compile(
+    r"\s*(?:[\(\[]|\s-\s).*?\b(?:remaster(?:ed)?|single|album|radio edit|mono|stereo|deluxe|bonus track|anniversary|explicit|clean)\b.*$",
+    re.IGNORECASE,
+)
+FEATURING = re.compile(r"\s*[\(\[](?:feat\.?|ft\.?|featuring|with)\s[^\)\]]*[\)\]]", re.IGNORECASE)
+
+# Returns a key identifying a song across releases: first artist plus the title without release suffixes or featured artists.
+def songKey(track):
+    title = FEATURING.sub("", track.get("name") or "")
+    title = RELEASE_SUFFIX.sub("", title)
+    title = " ".join(re.findall(r"\w+", title.lower()))
+    artists = track.get("artists") or []
+    artist = (artists[0].get("id") or (artists[0].get("name") or "").lower()) if artists else ""
+    if not title or not artist:
+        return None
+    return f"{artist}:{title}"
+
+# Reduces a Spotify track object to the fields used here, as (isrc, song key, duration ms, popularity).
+def trackInfo(track):
+    isrc = (track.get("external_ids") or {}).get("isrc")
+    return (isrc.upper() if isrc else None, songKey(track), track.get("duration_ms"), track.get("popularity"))
+
+class TrackMetadataStore:
+    def __init__(self, maxSize=200000, ttl=7 * 24 * 3600, enabled=False, maxConcurrent=4, headroom=0.5):
+        self.enabled = enabled
+        self.maxConcurrent = maxConcurrent
+        # Extra candidates looked up beyond numSongs, as a fraction of numSongs, to make up for merged and filtered tracks.
+        self.headroom = headroom
+        # trackID -> trackInfo() tuple, or None for IDs Spotify does not know.
+        self.cache = TTLCache(maxSize, ttl)
+
+    # Reads optional overrides from config.py (TRACK_HYDRATION, TRACK_METADATA_CACHE_SIZE, TRACK_METADATA_TTL,
+    # TRACK_HYDRATION_CONCURRENCY, TRACK_HYDRATION_HEADROOM). Called once from create_app().
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('TRACK_HYDRATION', self.enabled)
+        self.maxConcurrent = config.get('TRACK_HYDRATION_CONCURRENCY', self.maxConcurrent)
+        self.headroom = config.get('TRACK_HYDRATION_HEADROOM', self.headroom)
+        self.cache = TTLCache(config.get('TRACK_METADATA_CACHE_SIZE', self.cache.maxSize), config.get('TRACK_METADATA_TTL', self.cache.ttl))
+
+    # Returns a dict of trackID -> trackInfo() tuple (None if Spotify does not know the track). Cached tracks are not requested
+    # again, the rest are requested in batches of 50 with up to maxConcurrent batches in flight. Tracks of failed batches are left out.
+    def hydrate(self, accessToken, trackIDs):
+        info = {}
+        misses = []
+        for trackID in trackIDs:
+            cached = self.cache.get(trackID, MISSING)
+            if cached is MISSING:
+                misses.append(trackID)
+            else:
+                info[trackID] = cached
+        if not misses:
+            return info
+        batches = [misses[i:i + TRACK_BATCH_SIZE] for i in range(0, len(misses), TRACK_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.maxConcurrent, len(batches)))) as executor:
+            futures = [submitWithContext(executor, fetchTracks, accessToken, batch) for batch in batches]
+            for batch, future in zip(batches, futures):
+                tracks = future.result()
+                if tracks is None:
+                    continue
+                for trackID, track in zip(batch, tracks):
+                    value = trackInfo(track) if track else None
+                    self.cache.set(trackID, value)
+                    info[trackID] = value
+        print(f"Hydrated {len(misses)} tracks in {len(batches)} requests, {len(trackIDs) - len(misses)} from cache")
+        return info
+
+    # Drops filtered tracks and merges versions of the same song in ranked (trackID, score) tuples. Returns the result re-sorted by
+    # score, ties keeping their ranked order.
+    def dedupe(self, ranked, info, minDuration, maxDuration, minPopularity):
+        representatives = {}
+        merged = []
+        for trackID, score in ranked:
+            meta = info.get(trackID)
+            if meta is None:
+                merged.append([trackID, score])
+                continue
+            isrc, key, duration, popularity = meta
+            if duration is not None and ((minDuration and duration < minDuration) or (maxDuration and duration > maxDuration)):
+                continue
+            if minPopularity and popularity is not None and popularity < minPopularity:
+                continue
+            keys = [k for k in (("isrc", isrc), ("song", key)) if k[1]]
+            entry = next((representatives[k] for k in keys if k in representatives), None)
+            if entry is None:
+                entry = [trackID, score]
+                merged.append(entry)
+            else:
+                entry[1] += score
+            for k in keys:
+                representatives.setdefault(k, entry)
+        merged.sort(key=lambda entry: -entry[1])
+        return [(trackID, score) for trackID, score in merged]
+
+    # Returns the numSongs best tracks as (trackID, score) tuples. rank(k) returns the k best candidates (an aggregator's topK(), or
+    # a candidate pool's rank()). Without hydration this is just rank(numSongs). Must be called with an app context.
+    def rank(self, accessToken, rank, numSongs):
+        if not self.enabled or numSongs <= 0:
+            return rank(numSongs)
+        config = current_app.config
+        minDuration = config.get('TRACK_MIN_DURATION_MS')
+        maxDuration = config.get('TRACK_MAX_DURATION_MS')
+        minPopularity = config.get('TRACK_MIN_POPULARITY')
+        want = numSongs + max(10, int(numSongs * self.headroom))
+        with stage("hydrate"):
+            while True:
+                ranked = rank(want)
+                info = self.hydrate(accessToken, [trackID for trackID, _ in ranked])
+                result = self.dedupe(ranked, info, minDuration, maxDuration, minPopularity)
+                if len(result) >= numSongs or len(ranked) < want:
+                    break
+                want *= 2
+        if len(result) < len(ranked):
+            print(f"Merged or filtered {len(ranked) - len(result)} of {len(ranked)} candidate tracks using track metadata")
+        return result[:numSongs]
+
+# Single metadata store for this process.
+trackMetadata = TrackMetadataStore()
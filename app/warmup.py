@@ -0,0 +1,61 @@
+# Author: Adrian Simon
+# Background warm-up of the playlist corpus (playlist_corpus.py).
+# Every CORPUS_WARMUP_INTERVAL seconds the most common keyphrases (plus any listed in CORPUS_WARMUP_KEYPHRASES) that have not been
+# searched on Spotify for a while are searched again, with a larger limit than a user's search, so that users' searches for them
+# can be answered from the corpus. Searches use an app (client credentials) token, so no user has to be signed in.
+# The job is off unless CORPUS_WARMUP_INTERVAL is set in config.py. With several gunicorn workers each one runs it, but a keyphrase
+# refreshed by one worker is fresh for all of them since they share the corpus file.
+
+import threading
+import time
+
+from .playlist_corpus import playlistCorpus
+from .spotify import getClientToken, searchKeyphrase
+
+# Keyphrases refreshed per run when CORPUS_WARMUP_COUNT is not set.
+DEFAULT_WARMUP_COUNT = 50
+# Playlists requested per warm-up search, the most Spotify returns for one search.
+DEFAULT_WARMUP_SEARCH_LIMIT = 50
+
+# Refreshes the corpus for the most common stale keyphrases. Returns the number of keyphrases searched.
+def warmCorpus(app):
+    config = app.config
+    count = config.get('CORPUS_WARMUP_COUNT', DEFAULT_WARMUP_COUNT)
+    limit = config.get('CORPUS_WARMUP_SEARCH_LIMIT', DEFAULT_WARMUP_SEARCH_LIMIT)
+    # Keyphrases are refreshed once half their TTL has passed, so common ones never expire.
+    maxAge = playlistCorpus.ttl / 2
+    with app.app_context():
+        keyphrases = [k for k in config.get('CORPUS_WARMUP_KEYPHRASES', []) if playlistCorpus.needsRefresh(k, maxAge)]
+        for keyphrase in playlistCorpus.staleKeyphrases(count, maxAge):
+            if keyphrase not in keyphrases:
+                keyphrases.append(keyphrase)
+        if not keyphrases:
+            return 0
+        accessToken = getClientToken()
+        if not accessToken:
+            print("Skipping corpus warm-up, no client credentials token")
+            return 0
+        searched = 0
+        for keyphrase in keyphrases:
+            if searchKeyphrase(accessToken, keyphrase, limit, useCorpus=False) is not None:
+                searched += 1
+    print(f"Corpus warm-up refreshed {searched} of {len(keyphrases)} keyphrases")
+    return searched
+
+# Starts the warm-up thread if CORPUS_WARMUP_INTERVAL is set. Called once from create_app().
+def startWarmUp(app):
+    interval = app.config.get('CORPUS_WARMUP_INTERVAL')
+    if not interval or not playlistCorpus.enabled:
+        return None
+
+    def run():
+        while True:
+            try:
+                warmCorpus(app)
+            except Exception as e:
+                print(f"Corpus warm-up failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="corpus-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,53 @@
+# Author: Adrian Simon
+# Command-line entry point for bulk playlist generation, e.g. for seasonal campaigns.
+# Reads descriptions from a JSONL file, generates a playlist for each on a thread pool (see app/batch.py) and writes the results as JSONL.
+# Searches and playlist fetches shared by several descriptions are only made once per batch. Rerunning the same command after a
+# crash skips the jobs that already have a result.
+# Usage:
+#   python batch.py descriptions.jsonl results.jsonl --workers 8
+#   python batch.py descriptions.jsonl results.jsonl --user-token <token>   (also creates the playlists in that user's library)
+
+import argparse
+import sys
+
+from app import create_app
+from app.batch import DEFAULT_SIZE, loadJobs, runBatch
+from app.spotify import getClientToken
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate playlists in bulk from a JSONL file of descriptions.")
+    parser.add_argument("input", help="JSONL file with one job per line (description, optional id, size, excludeExplicit)")
+    parser.add_argument("output", help="JSONL file the results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="number of jobs generated at the same time")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="playlist size for jobs that do not set one")
+    parser.add_argument("--exclude-explicit", action="store_true", help="exclude explicit tracks for jobs that do not say otherwise")
+    parser.add_argument("--user-token", help="Spotify user access token, if given the playlists are created in that user's library")
+    parser.add_argument("--no-resume", action="store_true", help="overwrite the output file instead of skipping finished jobs")
+    args = parser.parse_args()
+
+    app = create_app()
+    jobs = loadJobs(args.input, args.size, args.exclude_explicit)
+    if not jobs:
+        sys.exit(f"No jobs found in {args.input}")
+
+    # Searches and playlist reads only need an app token, the user token is only needed to create playlists.
+    with app.app_context():
+        accessToken = args.user_token or getClientToken()
+    if not accessToken:
+        sys.exit("Could not get a Spotify access token, check CLIENT_ID and CLIENT_SECRET in config.py")
+
+    summary = runBatch(app, jobs, args.output, accessToken, args.workers, args.user_token, resume=not args.no_resume)
+
+    ran = summary["jobs"]
+    seconds = summary["seconds"]
+    print(f"Jobs: {ran} run ({summary['statuses']['ok']} ok, {summary['statuses']['failed']} failed), {summary['skipped']} skipped")
+    if ran:
+        print(f"Throughput: {ran / seconds:.2f} jobs/s over {seconds:.1f} s")
+        for service, calls in sorted(summary["calls"].items()):
+            print(f"API calls per job ({service}): {calls / ran:.2f}")
+    shared = summary["shared"]
+    print(f"Shared across the batch: {shared['calls']['search']} searches made, {shared['reused']['search']} reused; "
+          f"{shared['calls']['load']} playlist fetches made, {shared['reused']['load']} reused")
+
+if __name__ == '__main__':
+    main()
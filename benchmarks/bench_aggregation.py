@@ -0,0 +1,55 @@
+# Author: Adrian Simon
+# Accuracy and memory benchmark of the Space-Saving counter (app/heavy_hitters.py) against the exact TrackCounter (app/aggregation.py).
+# Uses the same Zipf-like synthetic playlists as bench_ranking.py. For every capacity it reports the memory held by the counter,
+# how many of the returned tracks really belong in the top k, the largest frequency error among them, and the error bound the
+# counter reports.
+# Run from the repository root: python -m benchmarks.bench_aggregation
+
+import argparse
+import time
+import tracemalloc
+
+from app.aggregation import TrackCounter
+from app.heavy_hitters import SpaceSavingCounter
+
+from .bench_ranking import makePlaylists
+
+# Runs the aggregator over every playlist and returns (elapsed seconds, memory allocated by the counter in bytes, top-k result).
+def measure(aggregator, playlists, k):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for j, entries in enumerate(playlists):
+        aggregator.addPlaylist(entries, (j % 7, j // 7), False)
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, memory, aggregator.topK(k)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Space-Saving counter against the exact counter.")
+    parser.add_argument("--candidates", type=int, default=200000, help="number of unique candidate tracks")
+    parser.add_argument("--capacities", type=int, nargs="+", default=[1000, 5000, 20000, 100000], help="Space-Saving capacities")
+    parser.add_argument("--k", type=int, default=100, help="number of tracks to select")
+    args = parser.parse_args()
+
+    playlists = makePlaylists(args.candidates)
+    occurrences = sum(len(entries) for entries in playlists)
+    print(f"{len(playlists)} playlists, {occurrences} occurrences, {args.candidates} candidate tracks, top {args.k}")
+
+    exact = TrackCounter()
+    exactTime, exactMemory, exactResult = measure(exact, playlists, args.k)
+    # Tracks tied with the k-th place may be returned in any order, so a track counts as correct if it is at least as frequent.
+    kthCount = exactResult[-1][1] if exactResult else 0
+
+    print(f"{'backend':>20} {'ms':>8} {'memory MB':>10} {'recall':>7} {'max error':>10} {'bound':>6} {'guaranteed':>11}")
+    print(f"{'exact':>20} {exactTime * 1000:>8.1f} {exactMemory / 1e6:>10.2f} {1.0:>7.2f} {0:>10} {0:>6} {'True':>11}")
+    for capacity in args.capacities:
+        counter = SpaceSavingCounter(capacity)
+        elapsed, memory, result = measure(counter, playlists, args.k)
+        recall = sum(1 for trackID, _ in result if exact.counts.get(trackID, 0) >= kthCount) / max(1, len(exactResult))
+        maxError = max((count - exact.counts.get(trackID, 0) for trackID, count in result), default=0)
+        print(f"{f'spacesaving {capacity}':>20} {elapsed * 1000:>8.1f} {memory / 1e6:>10.2f} {recall:>7.2f} {maxError:>10} "
+              f"{counter.errorBound():>6} {str(counter.topKGuaranteed(args.k)):>11}")
+
+if __name__ == '__main__':
+    main()
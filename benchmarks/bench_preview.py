@@ -0,0 +1,166 @@
+# Author: Adrian Simon
+# Offline end-to-end benchmark of /preview_playlist.
+# Starts the local Spotify/OpenAI stand-in (stub_server.py), points the app at it, and drives /preview_playlist through the
+# Flask test client from several threads at once. Reports latency percentiles, throughput, and outbound calls per request.
+# Run from the repository root, e.g.:
+#   python -m benchmarks.bench_preview --requests 200 --concurrency 8 --latency 80 --jitter 40 --rate429 0.02
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from .stub_server import StubState, loadFixtures, startStubServer
+
+DEFAULT_DESCRIPTIONS = os.path.join(os.path.dirname(__file__), "descriptions.jsonl")
+
+# Reads descriptions from a JSONL file. Each line may use "description", "prompt" or "title" as the key.
+def loadDescriptions(path):
+    descriptions = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            description = record.get("description") or record.get("prompt") or record.get("title")
+            if description:
+                descriptions.append(description)
+    return descriptions
+
+# The app reads its settings from a config module that is not checked in, so the benchmark provides its own.
+def installConfig(baseURL, cacheDirectory, coldCache, streamLLM=False, hydrate=False, corpus=False):
+    config = types.ModuleType("config")
+    config.OPENAI_API_KEY = "stub-key"
+    config.CLIENT_ID = "stub-client"
+    config.CLIENT_SECRET = "stub-secret"
+    config.REDIRECT_URI = "http://localhost/callback"
+    config.SECRET_KEY = "benchmark"
+    config.SPOTIFY_API_BASE = baseURL
+    config.SPOTIFY_ACCOUNTS_BASE = baseURL
+    config.SPOTIFY_BACKOFF_BASE = 0.05
+    config.PLAYLIST_CACHE_PATH = os.path.join(cacheDirectory, "playlist_cache.sqlite3")
+    config.PLAYLIST_CACHE_ENABLED = not coldCache
+    config.CORPUS_PATH = os.path.join(cacheDirectory, "playlist_corpus.sqlite3")
+    config.CORPUS_ENABLED = corpus and not coldCache
+    config.LLM_STREAMING = streamLLM
+    config.TRACK_HYDRATION = hydrate
+    sys.modules["config"] = config
+    return config
+
+# Returns the p-th percentile of a list of numbers.
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /preview_playlist against a local Spotify/OpenAI stand-in.")
+    parser.add_argument("--requests", type=int, default=50, help="total number of /preview_playlist requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent clients")
+    parser.add_argument("--size", type=int, default=30, help="playlistSize sent with every request")
+    parser.add_argument("--exclude-explicit", action="store_true", help="send excludeExplicit=on")
+    parser.add_argument("--descriptions", default=DEFAULT_DESCRIPTIONS, help="JSONL file of descriptions")
+    parser.add_argument("--fixtures", help="directory of recorded payloads (search.json, playlists.json, completions.json)")
+    parser.add_argument("--latency", type=float, default=50, help="upstream latency in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="upstream latency jitter in ms")
+    parser.add_argument("--rate429", type=float, default=0.0, help="fraction of upstream calls answered with 429")
+    parser.add_argument("--rate5xx", type=float, default=0.0, help="fraction of upstream calls answered with 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--playlist-length", type=int, default=150, help="tracks per synthetic playlist")
+    parser.add_argument("--token-delay", type=float, default=0, help="delay between streamed completion chunks in ms")
+    parser.add_argument("--stream-llm", action="store_true", help="use one streamed completion for keyphrases and name (LLM_STREAMING)")
+    parser.add_argument("--hydrate", action="store_true", help="look up track metadata and merge versions of the same song (TRACK_HYDRATION)")
+    parser.add_argument("--corpus", action="store_true", help="answer searches from the local playlist corpus when possible (CORPUS_ENABLED)")
+    parser.add_argument("--cold", action="store_true", help="disable the playlist cache and clear the LLM caches before every request")
+    args = parser.parse_args()
+
+    state = StubState(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        rate429=args.rate429,
+        rate5xx=args.rate5xx,
+        retryAfter=args.retry_after,
+        playlistLength=args.playlist_length,
+        fixtures=loadFixtures(args.fixtures),
+        tokenDelay=args.token_delay / 1000,
+    )
+    server, baseURL = startStubServer(state)
+    cacheDirectory = tempfile.mkdtemp(prefix="jamify-bench-")
+    installConfig(baseURL, cacheDirectory, args.cold, args.stream_llm, args.hydrate, args.corpus)
+
+    import openai
+    from app import create_app
+    from app import gpt_integration
+
+    openai.api_base = f"{baseURL}/v1"
+    app = create_app()
+    descriptions = loadDescriptions(args.descriptions)
+    if not descriptions:
+        sys.exit(f"No descriptions found in {args.descriptions}")
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            # Every request acts as a different user, so the client's per-token rate limiter behaves as it would in production.
+            # The session looks like one after /callback (see credentials.py): the user ID is already known.
+            with client.session_transaction() as session:
+                session['access_token'] = f"stub-token-{i}"
+                session['token_expires_at'] = time.time() + 3600
+                session['user_id'] = "stub-user"
+            if args.cold:
+                gpt_integration.keyphraseCache.clear()
+                gpt_integration.nameCache.clear()
+            form = {"playlistDescription": descriptions[i % len(descriptions)], "playlistSize": str(args.size)}
+            if args.exclude_explicit:
+                form["excludeExplicit"] = "on"
+            start = time.perf_counter()
+            response = client.post('/preview_playlist', data=form)
+            elapsed = (time.perf_counter() - start) * 1000
+            # Error pages are rendered with status 200, so tell them apart by the preview iframe.
+            ok = response.status_code == 200 and b"open.spotify.com/embed/playlist" in response.data
+            with lock:
+                latencies.append(elapsed)
+                key = "ok" if ok else f"error ({response.status_code})"
+                statuses[key] = statuses.get(key, 0) + 1
+
+    state.reset()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    calls = state.snapshot()
+    server.shutdown()
+
+    total = len(latencies)
+    print(f"Requests: {total} with {args.concurrency} concurrent clients in {wall:.2f} s ({total / wall:.2f} req/s)")
+    print(f"Results: {statuses}")
+    print(f"Latency ms: p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+          f"p99 {percentile(latencies, 99):.1f}  mean {statistics.mean(latencies):.1f}  max {max(latencies):.1f}")
+    print(f"Outbound calls per request: {sum(calls.values()) / total:.2f}")
+    for endpoint, count in sorted(calls.items()):
+        print(f"  {endpoint:<40} {count / total:>7.2f}")
+    print(f"Upstream statuses: {dict(sorted(state.statuses.items()))}")
+    print(f"LLM cache: {gpt_integration.cacheStats()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Author: Adrian Simon
+# Micro-benchmark of the NumPy ranking engine (app/ranking.py) against the original dictionary + min-heap path
+# (dictionary counting + topKMostFrequentTracks()). Candidate occurrences are drawn from a Zipf-like distribution, which is roughly
+# what track frequencies across playlists look like: a few tracks appear everywhere, most appear once.
+# Run from the repository root: python -m benchmarks.bench_ranking
+
+import argparse
+import random
+import time
+
+from app.ranking import RankingEngine
+from app.spotify import topKMostFrequentTracks
+
+# The original sequential counting: a dictionary of track ID to frequency, ranked by the min-heap.
+class DictHeapCounter:
+    def __init__(self):
+        self.tracks = {}
+
+    def addPlaylist(self, entries, playlistOrder, excludeExplicit):
+        tracks = self.tracks
+        for trackID, explicit in entries:
+            if excludeExplicit and explicit:
+                continue
+            tracks[trackID] = tracks.get(trackID, 0) + 1
+
+    def topK(self, k):
+        return topKMostFrequentTracks(self.tracks, k)
+
+# Builds playlists of (trackID, explicit) entries containing roughly numCandidates unique tracks.
+def makePlaylists(numCandidates, playlistSize=100, seed=0):
+    rng = random.Random(seed)
+    ids = [f"{i:022d}" for i in range(numCandidates)]
+    totalOccurrences = numCandidates * 2
+    playlists = []
+    for start in range(0, totalOccurrences, playlistSize):
+        entries = []
+        for _ in range(min(playlistSize, totalOccurrences - start)):
+            index = min(int(rng.paretovariate(1.1)) - 1, numCandidates - 1)
+            # Mix the popular head with a uniform tail so every candidate has a chance of appearing.
+            if rng.random() < 0.5:
+                index = rng.randrange(numCandidates)
+            entries.append((ids[index], rng.random() < 0.1))
+        playlists.append(entries)
+    return playlists
+
+# Runs the aggregator over every playlist and returns (elapsed seconds, top-k result).
+def run(aggregator, playlists, k):
+    start = time.perf_counter()
+    for j, entries in enumerate(playlists):
+        aggregator.addPlaylist(entries, (j % 7, j // 7), False)
+    result = aggregator.topK(k)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ranking engine against the dictionary + heap path.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 50000, 1000000], help="numbers of unique candidate tracks")
+    parser.add_argument("--k", type=int, default=100, help="number of tracks to select")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size, the best run is reported")
+    args = parser.parse_args()
+
+    print(f"{'candidates':>12} {'heap ms':>10} {'numpy ms':>10} {'weighted ms':>12} {'speedup':>8} {'same scores':>12}")
+    for size in args.sizes:
+        playlists = makePlaylists(size)
+        heapBest = numpyBest = weightedBest = float("inf")
+        for _ in range(args.repeat):
+            heapTime, heapResult = run(DictHeapCounter(), playlists, args.k)
+            numpyTime, numpyResult = run(RankingEngine(), playlists, args.k)
+            weightedTime, _ = run(RankingEngine({"keyphraseDecay": 0.2, "playlistDecay": 0.1, "trackDecay": 0.01}), playlists, args.k)
+            heapBest = min(heapBest, heapTime)
+            numpyBest = min(numpyBest, numpyTime)
+            weightedBest = min(weightedBest, weightedTime)
+        # The heap breaks ties arbitrarily, so only compare the scores that made the cut.
+        sameScores = sorted(f for _, f in heapResult) == sorted(f for _, f in numpyResult)
+        print(f"{size:>12} {heapBest * 1000:>10.1f} {numpyBest * 1000:>10.1f} {weightedBest * 1000:>12.1f} "
+              f"{heapBest / numpyBest:>7.2f}x {str(sameScores):>12}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# Author: Adrian Simon
+# Local stand-in for the Spotify Web API, Spotify accounts service and OpenAI chat completions API, used by the benchmarks.
+# Responses are either replayed from recorded payloads (see loadFixtures) or generated deterministically from the request,
+# so the same description always produces the same keyphrases, search results and playlist contents.
+# Latency, jitter, 429s (with Retry-After) and 5xx errors can be injected to see how the app behaves against a slow or flaky upstream.
+# Every request is counted per endpoint so benchmarks can report outbound calls per generated playlist.
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Size of the pool that synthetic playlists draw tracks from. Smaller pools mean more overlap between playlists.
+TRACK_POOL_SIZE = 5000
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Returns a stable integer seed for a string.
+def seedFor(value):
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+# Returns a valid looking 22 character base62 Spotify ID derived from a string.
+def spotifyID(value):
+    number = seedFor(value)
+    chars = []
+    for _ in range(22):
+        number, digit = divmod(number * 7919 + 17, 62)
+        chars.append(BASE62[digit])
+    return "".join(chars)
+
+# Loads recorded payloads from a directory. Every file is optional:
+#   search.json      {"<query>": <Spotify search response>}
+#   playlists.json   {"<playlist ID>": [<playlist track item>, ...]}
+#   completions.json {"<description>": "<completion content>"}
+def loadFixtures(directory):
+    fixtures = {"search": {}, "playlists": {}, "completions": {}}
+    if not directory:
+        return fixtures
+    for name in fixtures:
+        path = os.path.join(directory, f"{name}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                fixtures[name] = json.load(f)
+    return fixtures
+
+class StubState:
+    def __init__(self, latency=0.0, jitter=0.0, rate429=0.0, rate5xx=0.0, retryAfter=1, playlistLength=150, fixtures=None, seed=0,
+                 tokenDelay=0.0):
+        self.latency = latency
+        # Delay between streamed completion chunks, to mimic a model generating tokens.
+        self.tokenDelay = tokenDelay
+        self.jitter = jitter
+        self.rate429 = rate429
+        self.rate5xx = rate5xx
+        self.retryAfter = retryAfter
+        self.playlistLength = playlistLength
+        self.fixtures = fixtures or loadFixtures(None)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.statuses = {}
+        # Track URIs written to created playlists, so writes can be checked for order and limits.
+        self.written = {}
+        self.trackIndex = {spotifyID(f"track:{i}"): i for i in range(TRACK_POOL_SIZE)}
+
+    # Applies a write to a created playlist. Like Spotify, more than 100 URIs in one request is rejected. Returns the status code.
+    def writeTracks(self, playlistID, uris, replace):
+        if len(uris) > 100:
+            return 400
+        with self.lock:
+            if replace:
+                self.written[playlistID] = list(uris)
+            else:
+                self.written.setdefault(playlistID, []).extend(uris)
+        return 200 if replace else 201
+
+    def record(self, endpoint, status):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    # Returns a copy of the per-endpoint request counters.
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.statuses.clear()
+
+    # Sleeps for the configured latency plus jitter and decides whether to inject a failure. Returns the status to fail with, or None.
+    def delay(self):
+        with self.lock:
+            sleep = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            roll = self.random.random()
+        time.sleep(max(0.0, sleep))
+        if roll < self.rate429:
+            return 429
+        if roll < self.rate429 + self.rate5xx:
+            return 503
+        return None
+
+    def searchResponse(self, query, limit):
+        recorded = self.fixtures["search"].get(query)
+        if recorded is not None:
+            return recorded
+        # Queries sharing words share playlists, like popular playlists coming back for many prompts.
+        words = sorted(set(re.findall(r"\w+", query.lower()))) or ["none"]
+        items = []
+        for i in range(limit):
+            word = words[i % len(words)]
+            name = f"{word} mix {i // len(words)}"
+            items.append({
+                "id": spotifyID(f"playlist:{name}"),
+                "name": name,
+                "description": f"The best {word} songs",
+                "snapshot_id": spotifyID(f"snapshot:{name}"),
+                "owner": {"id": "stub", "display_name": "Stub"},
+            })
+        return {"playlists": {"items": items, "next": None}}
+
+    def playlistItems(self, playlistID):
+        recorded = self.fixtures["playlists"].get(playlistID)
+        if recorded is not None:
+            return recorded
+        rng = random.Random(seedFor(playlistID))
+        items = []
+        for _ in range(self.playlistLength):
+            # Skewed towards the start of the pool so some tracks appear in many playlists.
+            index = min(int(rng.paretovariate(0.8)) - 1, TRACK_POOL_SIZE - 1)
+            items.append({"track": {"id": spotifyID(f"track:{index}"), "explicit": index % 5 == 0}})
+        return items
+
+    # Full track object for a synthetic track. Some tracks are other releases of the track before them, so duplicate detection
+    # has something to find: every 20th shares its ISRC (a compilation), every other 10th is a remaster with its own ISRC.
+    def trackObject(self, trackID):
+        index = self.trackIndex.get(trackID)
+        if index is None:
+            return None
+        song, suffix, isrc = index, "", f"STUB{index:08d}"
+        if index % 20 == 19:
+            song, isrc = index - 1, f"STUB{index - 1:08d}"
+        elif index % 10 == 9:
+            song, suffix = index - 1, " - Remastered 2011"
+        return {
+            "id": trackID,
+            "name": f"Song {song}{suffix}",
+            "artists": [{"id": spotifyID(f"artist:{song % 700}"), "name": f"Artist {song % 700}"}],
+            "duration_ms": 120000 + seedFor(f"duration:{song}") % 240000,
+            "popularity": max(0, 90 - song // 60),
+            "explicit": index % 5 == 0,
+            "external_ids": {"isrc": isrc},
+        }
+
+    def completion(self, prompt):
+        # The prompts contain an example description before the real one, which is always last.
+        matches = re.findall(r"Description: (.*)", prompt)
+        description = matches[-1].strip() if matches else prompt.strip()
+        recorded = self.fixtures["completions"].get(description)
+        if recorded is not None:
+            return recorded
+        if "Playlist Description" in prompt:
+            return f"{description.title()[:40]} Mix"
+        words = [w for w in re.findall(r"[a-z0-9]+", description.lower()) if len(w) > 2][:6] or ["none"]
+        keyphrases = ",".join(f"{word} music" for word in words)
+        # The combined keyphrase + name prompt (streamKeyphrasesAndName() in gpt_integration.py).
+        if "Name:" in prompt and words != ["none"]:
+            return f"{keyphrases}\nName: {description.title()[:40]} Mix"
+        return keyphrases
+
+# Request handler. The server instance carries the StubState as server.state.
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendJSON(self, endpoint, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.state.record(endpoint, status)
+
+    # Sends a completion as Server-Sent Events the way OpenAI streams it, a few characters per chunk.
+    def sendStream(self, endpoint, content):
+        state = self.server.state
+        state.record(endpoint, 200)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i in range(0, len(content), 4):
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "model": "stub",
+                     "choices": [{"index": 0, "delta": {"content": content[i:i + 4]}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            if state.tokenDelay:
+                time.sleep(state.tokenDelay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def readBody(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def handle_request(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.readBody()
+        path = url.path
+        endpoint = self.endpointName(method, path)
+
+        failure = state.delay()
+        if failure == 429:
+            return self.sendJSON(endpoint, 429, {"error": {"status": 429, "message": "rate limited"}}, {"Retry-After": str(state.retryAfter)})
+        if failure:
+            return self.sendJSON(endpoint, failure, {"error": {"status": failure, "message": "injected failure"}})
+
+        if method == "POST" and path == "/api/token":
+            return self.sendJSON(endpoint, 200, {"access_token": "stub-token", "refresh_token": "stub-refresh", "expires_in": 3600})
+        if method == "POST" and path.endswith("/chat/completions"):
+            request = json.loads(body or b"{}")
+            messages = request.get("messages", [])
+            content = state.completion(messages[-1]["content"] if messages else "")
+            if request.get("stream"):
+                return self.sendStream(endpoint, content)
+            # A non-streamed completion arrives once every token has been generated.
+            time.sleep(state.tokenDelay * ((len(content) + 3) // 4))
+            return self.sendJSON(endpoint, 200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        if method == "GET" and path == "/v1/me":
+            return self.sendJSON(endpoint, 200, {"id": "stub-user"})
+        if method == "GET" and path == "/v1/search":
+            limit = int(query.get("limit", ["5"])[0])
+            return self.sendJSON(endpoint, 200, state.searchResponse(query.get("q", [""])[0], limit))
+        if method == "GET" and path == "/v1/tracks":
+            ids = [i for i in query.get("ids", [""])[0].split(",") if i]
+            if len(ids) > 50:
+                return self.sendJSON(endpoint, 400, {"error": {"status": 400, "message": "Too many ids requested"}})
+            return self.sendJSON(endpoint, 200, {"tracks": [state.trackObject(i) for i in ids]})
+        match = re.fullmatch(r"/v1/playlists/([^/]+)/tracks", path)
+        if match and method == "GET":
+            items = state.playlistItems(match.group(1))
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["100"])[0])
+            page = items[offset:offset + limit]
+            hasNext = offset + limit < len(items)
+            nextURL = f"http://{self.headers.get('Host')}{path}?offset={offset + limit}&limit={limit}" if hasNext else None
+            return self.sendJSON(endpoint, 200, {"items": page, "next": nextURL, "total": len(items)})
+        if match and method in ("POST", "PUT"):
+            uris = json.loads(body or b"{}").get("uris", [])
+            status = state.writeTracks(match.group(1), uris, replace=method == "PUT")
+            if status == 400:
+                return self.sendJSON(endpoint, 400, {"error": {"status": 400, "message": "You can add a maximum of 100 tracks per request."}})
+            return self.sendJSON(endpoint, status, {"snapshot_id": "stub-snapshot"})
+        if re.fullmatch(r"/v1/playlists/[^/]+", path) and method == "GET":
+            with state.lock:
+                total = len(state.written.get(path.rsplit("/", 1)[1], []))
+            return self.sendJSON(endpoint, 200, {"tracks": {"total": total}})
+        if re.fullmatch(r"/v1/users/[^/]+/playlists", path) and method == "POST":
+            return self.sendJSON(endpoint, 201, {"id": spotifyID(f"temp:{time.perf_counter_ns()}")})
+        if re.fullmatch(r"/v1/playlists/[^/]+", path) and method == "PUT":
+            return self.sendJSON(endpoint, 200, {})
+        if re.fullmatch(r"/v1/playlists/[^/]+/followers", path) and method == "DELETE":
+            return self.sendJSON(endpoint, 200, {})
+        return self.sendJSON(endpoint, 404, {"error": {"status": 404, "message": f"no stub for {method} {path}"}})
+
+    # Groups paths into endpoint names for the call counters, e.g. "GET /v1/playlists/{id}/tracks".
+    def endpointName(self, method, path):
+        path = re.sub(r"/v1/(playlists|users)/[^/]+", r"/v1/\1/{id}", path)
+        return f"{method} {path}"
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+# Starts the stub server on a background thread and returns (server, base URL). Stop it with server.shutdown().
+def startStubServer(state, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"